@@ -1,19 +1,52 @@
 import logging
-import sqlite3
 import csv
+import asyncio
+import bisect
+import heapq
+import itertools
+import math
+import functools
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ApplicationBuilder,
+    BaseUpdateProcessor,
+    BasePersistence,
+    PersistenceInput,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     filters,
     ConversationHandler,
     ContextTypes,
-    CallbackContext
+    CallbackContext,
+    ChatMemberHandler
 )
+from telegram.error import RetryAfter, Forbidden, BadRequest
+from telegram.request import BaseRequest, HTTPXRequest
 from datetime import datetime, timedelta
 import os
+import time
+import json
+import html
+import re
+import hmac
+import ipaddress
+import secrets
+import signal
+from http import HTTPStatus
+from storage import (
+    Database, QueryProfiler, handler_phases, current_handler, add_phase_time,
+    PARSED_APPLICATION_COLUMNS, SQL_STORE_PARSED, APPLICATION_INDEXES, APPLICATION_COUNTER_TRIGGERS,
+    APPLICATION_FTS_COLUMNS, APPLICATION_FTS_TRIGGERS, fts_values, LIST_FIRST, LIST_AFTER, LIST_BEFORE,
+    SQL_ACTIVE_APPS, SQL_ACTIVE_APP, SQL_USER_ACTIVE_APPS, SQL_DEACTIVATE_USER_APPS, SQL_EXPIRE_APPS,
+    SQL_PARSE_BACKFILL, SQL_OUTBOX_DUE, SQL_OUTBOX_NEXT_DUE, SQL_SEARCH, SQL_SEARCH_COUNT
+)
+
+# NumPy необязателен: без него сортировка "лучшие для меня" считается циклом через match_scorer
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Настройка логирования
 logging.basicConfig(
@@ -23,17 +56,66 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Состояния для ConversationHandler
-CHOOSING, TYPING_APPLICATION, TYPING_ADMIN_INPUT, EDITING = range(4)
+CHOOSING, TYPING_APPLICATION, TYPING_ADMIN_INPUT, EDITING, TYPING_SEARCH = range(5)
 
 # ID каналов для проверки подписки
 CHANNEL_RUSTRIC = "@rustrics"
 CHANNEL_DENZI = "@denziserver"
 
+# Бот - администратор обоих каналов и получает обновления chat_member,
+# поэтому записи о подписке не устаревают. Отсутствие подписки все равно
+# перепроверяется: пропущенное обновление не должно закрыть доступ навсегда
+SUBSCRIPTIONS_TRACKED_BY_EVENTS = True
+
+# Через это время (в секундах) локальные записи о подписке устаревают, если обновления
+# chat_member не приходят. Отрицательный результат устаревает всегда и живет меньше,
+# чтобы только что подписавшийся пользователь быстро получил доступ
+SUBSCRIPTION_CACHE_TTL = 600
+SUBSCRIPTION_NEGATIVE_CACHE_TTL = 30
+
+# Сколько пользователей в секунду проверять при фоновой сверке подписок
+SUBSCRIPTION_BACKFILL_RATE = 5
+
 # ID админов через запятую
 ADMIN_IDS = "7642825895,1947369214"  # Замените на реальные ID админов
 
 # ID чата для уведомлений
 NOTIFICATION_CHAT_ID = -1002569594175
+# Уведомления, пришедшие в течение окна после предыдущей отправки, собираются в одну сводку
+NOTIFICATION_DIGEST_WINDOW = 60
+
+# Режим получения обновлений: 'polling' или 'webhook'
+BOT_MODE = 'polling'
+
+# Настройки вебхука. Если WEBHOOK_URL пустой, бот не регистрирует вебхук в Telegram -
+# так сервер можно проверить локально, отправляя POST с JSON обновления на WEBHOOK_PATH
+WEBHOOK_LISTEN = '0.0.0.0'
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/telegram'
+WEBHOOK_URL = ''  # например 'https://bot.example.com'
+# Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token. Если пустой, а WEBHOOK_URL задан,
+# при запуске генерируется случайный токен - без него кто угодно мог бы слать поддельные обновления.
+# Без токена сервер слушает только 127.0.0.1, какой бы WEBHOOK_LISTEN ни был задан
+WEBHOOK_SECRET_TOKEN = ''
+WEBHOOK_MAX_CONNECTIONS = 40  # одновременных соединений от Telegram
+WEBHOOK_MAX_PENDING_UPDATES = 1000  # при переполнении очереди отвечаем 503, Telegram повторит позже
+
+# Параллельная обработка обновлений: обновления одного пользователя идут по очереди,
+# разных пользователей - одновременно, не более UPDATE_CONCURRENCY за раз
+UPDATE_CONCURRENCY = 16
+UPDATE_MAX_PENDING = 1024
+# Как часто писать в лог глубину очереди и время ожидания обновлений (в секундах)
+UPDATE_METRICS_INTERVAL = 300
+
+# Локальный HTTP-эндпоинт /metrics в формате Prometheus (None - не запускать)
+METRICS_LISTEN = '127.0.0.1'
+METRICS_PORT = 9090
+
+# Размер пула соединений бота с Bot API (как по умолчанию в python-telegram-bot)
+BOT_CONNECTION_POOL_SIZE = 256
+
+# Как часто измененные состояния диалогов и user_data записываются в базу (в секундах)
+PERSISTENCE_UPDATE_INTERVAL = 5
 
 # Период проверки старых заявок (в секундах)
 CHECK_OLD_APPLICATIONS_INTERVAL = 86400  # 1 день
@@ -41,9 +123,45 @@ CHECK_OLD_APPLICATIONS_INTERVAL = 86400  # 1 день
 # Файл для хранения информации о пользователях
 USERS_FILE = 'users.csv'
 
+# Как часто новые пользователи записываются в базу и в USERS_FILE (в секундах)
+USERS_FLUSH_INTERVAL = 5
+
+# Ограничения на рассылку уведомлений (лимиты Telegram: ~30 сообщений в секунду
+# на бота, 1 в секунду в личный чат, 20 в минуту в группу)
+BROADCAST_GLOBAL_RATE = 25
+BROADCAST_PRIVATE_CHAT_INTERVAL = 1
+BROADCAST_GROUP_CHAT_INTERVAL = 3
+BROADCAST_CONCURRENCY = 8
+BROADCAST_MAX_ATTEMPTS = 5
+OUTBOX_BATCH_SIZE = 100
+
 # Глобальная переменная для периода автоудаления (по умолчанию 3 дня)
 AUTO_DELETE_DAYS = 3
 
+# Как часто индекс активных заявок в памяти сверяется с базой (в секундах)
+ACTIVE_APPS_CHECK_INTERVAL = 600
+
+# Подбор тиммейтов для новой заявки: сколько лучших совпадений присылать и минимальная оценка (0..1)
+MATCH_TOP_N = 3
+MATCH_MIN_SCORE = 0.6
+# Кандидаты берутся из соседних диапазонов часов, из каждого не больше MATCH_CANDIDATES_PER_BUCKET новейших
+MATCH_HOURS_BUCKETS = (300, 1000, 3000, 8000)
+MATCH_CANDIDATES_PER_BUCKET = 100
+MATCH_WEIGHTS = {'hours': 0.35, 'online': 0.3, 'age': 0.15, 'roles': 0.2}
+# Разница, при которой близость по полю падает до нуля (часы сравниваются в log10)
+MATCH_SCALES = {'hours': 1, 'online': 8, 'age': 15}
+MATCH_SCORE_DIGITS = 9
+# Не чаще одного уведомления о новых тиммейтах на пользователя за это время (в секундах)
+MATCH_NOTIFY_COOLDOWN = 3600
+
+# Размер пачки при переводе старых строковых дат в epoch-секунды
+DATE_MIGRATION_BATCH_SIZE = 500
+
+# Версия разбора полей заявки в числа и теги ролей; при изменении правил разбора
+# увеличьте ее, и backfill_parsed_fields() переразберет старые заявки
+APPLICATION_PARSE_VERSION = 1
+PARSE_BACKFILL_BATCH_SIZE = 500
+
 # Типы команд
 TEAM_TYPES = {
     'duo': 'Duo',
@@ -53,56 +171,606 @@ TEAM_TYPES = {
     'clan': 'Клан'
 }
 
+# Файл базы данных
+DB_FILE = 'rust_bot.db'
+
+# Количество потоков для чтения из базы (запись всегда идет через один поток)
+DB_READER_THREADS = 2
+
+# Профилирование запросов к базе: каждый запрос учитывается с текстом, типами параметров,
+# числом строк, временем и обработчиком, из которого он вызван
+QUERY_PROFILING = True
+SLOW_QUERY_THRESHOLD = 0.1  # секунд; более медленные запросы пишутся в лог сразу
+QUERY_REPORT_INTERVAL = 3600
+QUERY_REPORT_TOP = 10
+QUERY_REPORT_CHAT_ID = None  # например NOTIFICATION_CHAT_ID; None - отчет только в лог
+
+# Метрики в формате Prometheus
+class Metrics:
+    """Счетчики и гистограммы с метками. Все значения меняются только из event loop."""
+
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            # Счетчики по корзинам, затем сумма и количество наблюдений
+            histogram = self._histograms[key] = [0] * (len(self.LATENCY_BUCKETS) + 2)
+        for i, bound in enumerate(self.LATENCY_BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def gauge(self, name, func):
+        """Регистрирует значение, которое вычисляется func() в момент выгрузки."""
+        self._gauges[name] = func
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = [f'{name}="{value}"' for name, value in labels + extra]
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self):
+        lines = []
+        seen = set()
+        for (name, labels), value in sorted(self._counters.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{self._format_labels(labels)} {value}')
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            for bound, count in zip(self.LATENCY_BUCKETS, histogram):
+                lines.append(f'{name}_bucket{self._format_labels(labels, (("le", bound),))} {count}')
+            lines.append(f'{name}_bucket{self._format_labels(labels, (("le", "+Inf"),))} {histogram[-1]}')
+            lines.append(f'{name}_sum{self._format_labels(labels)} {histogram[-2]}')
+            lines.append(f'{name}_count{self._format_labels(labels)} {histogram[-1]}')
+        for name, func in sorted(self._gauges.items()):
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {func()}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+query_profiler = QueryProfiler(SLOW_QUERY_THRESHOLD)
+metrics.gauge('bot_db_slow_queries', lambda: query_profiler.slow_total)
+
+def timed_handler(callback):
+    """Оборачивает обработчик: пишет в metrics общее время, время запросов к базе (db),
+    к Bot API (api) и остальное время (render: логика и форматирование), а также ошибки.
+    Вложенные вызовы других обработчиков учитываются во внешнем."""
+    name = callback.__name__
+    
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        if handler_phases.get() is not None:
+            return await callback(update, context)
+        phases = {}
+        token = handler_phases.set(phases)
+        handler_token = current_handler.set(name)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            count_handler_error(name)
+            raise
+        finally:
+            current_handler.reset(handler_token)
+            handler_phases.reset(token)
+            total = time.perf_counter() - started
+            db_time, api_time = phases.get('db', 0.0), phases.get('api', 0.0)
+            metrics.observe('bot_handler_duration_seconds', total, handler=name, phase='total')
+            metrics.observe('bot_handler_duration_seconds', db_time, handler=name, phase='db')
+            metrics.observe('bot_handler_duration_seconds', api_time, handler=name, phase='api')
+            # Параллельные запросы (asyncio.gather) могут дать db + api больше общего времени
+            metrics.observe('bot_handler_duration_seconds', max(total - db_time - api_time, 0.0), handler=name, phase='render')
+    
+    return wrapper
+
+def count_handler_error(handler):
+    """Учитывает в bot_handler_errors_total ошибку, которую обработчик перехватил сам."""
+    metrics.increment('bot_handler_errors_total', handler=handler)
+
+async def report_query_stats(context: CallbackContext):
+    report = query_profiler.report(QUERY_REPORT_TOP, reset=True)
+    logger.info(report)
+    if QUERY_REPORT_CHAT_ID is not None:
+        try:
+            await context.bot.send_message(chat_id=QUERY_REPORT_CHAT_ID, text=report[:4096])
+        except Exception as e:
+            logger.error(f"Ошибка при отправке отчета о запросах: {e}")
+
+db = Database(DB_FILE, DB_READER_THREADS, query_profiler if QUERY_PROFILING else None)
+
+def add_column_if_missing(cursor, table, column, column_type):
+    columns = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+# Разбор текстовых полей заявки в числа и теги ролей
+# Теги ролей и основы слов, по которым они узнаются. Порядок задает биты role_mask
+# в базе, поэтому новые теги добавляются только в конец.
+ROLE_TAGS = {
+    'combat': ('комбат', 'пвп', 'pvp', 'стрел', 'боец', 'бойц', 'combat', 'аим', 'aim'),
+    'farm': ('фарм', 'farm', 'собира', 'добыт'),
+    'build': ('строит', 'строй', 'билд', 'build'),
+    'electric': ('электр', 'electr'),
+    'raid': ('рейд', 'raid'),
+    'craft': ('крафт', 'craft'),
+    'pilot': ('пилот', 'вертол', 'коптер', 'heli'),
+    'leader': ('лидер', 'leader', 'руковод', 'стратег'),
+    'universal': ('универс', 'любая', 'любой', 'любые', 'any'),
+}
+ROLE_BITS = {tag: 1 << i for i, tag in enumerate(ROLE_TAGS)}
+ROLE_LABELS = {
+    'combat': 'ПвП',
+    'farm': 'Фарм',
+    'build': 'Строитель',
+    'electric': 'Электрик',
+    'raid': 'Рейдер',
+    'craft': 'Крафтер',
+    'pilot': 'Пилот',
+    'leader': 'Лидер',
+    'universal': 'Универсал',
+}
+
+_WORD_RE = re.compile(r'[a-zа-я0-9]+')
+_NUMBER_RE = re.compile(r'\d+(?:[.,]\d+)?')
+# "11 000" -> "11000"
+_THOUSANDS_SEPARATOR_RE = re.compile(r'(?<=\d)[ \u00a0](?=\d{3}(?!\d))')
+# "11000", "11к", "2.5k", "3 тыс."
+_HOURS_RE = re.compile(r'(\d+(?:[.,]\d+)?)\s*(тыс|[кk](?![a-zа-я]))?')
+
+def parse_int(text, low, high):
+    """Первое число в тексте, если оно в пределах [low, high], иначе None."""
+    match = _NUMBER_RE.search(text or '')
+    if match is None:
+        return None
+    value = int(float(match.group().replace(',', '.')))
+    return value if low <= value <= high else None
+
+def parse_hours(text):
+    match = _HOURS_RE.search(_THOUSANDS_SEPARATOR_RE.sub('', (text or '').lower()))
+    if match is None:
+        return None
+    value = float(match.group(1).replace(',', '.'))
+    if match.group(2):
+        value *= 1000
+    return int(value) if value <= 100000 else None
+
+def parse_role_tags(text):
+    words = _WORD_RE.findall((text or '').lower().replace('ё', 'е'))
+    return [
+        tag for tag, stems in ROLE_TAGS.items()
+        if any(word.startswith(stems) for word in words)
+    ]
+
+def parse_application(app_type, fields):
+    """Разбирает первые четыре поля формы заявки (в порядке формы).
+    Возвращает значения PARSED_APPLICATION_COLUMNS без parse_version; role_mask -
+    роль игрока у тиммейта и кого ищет клан у клана."""
+    if app_type == 'teammate':
+        age, hours, roles, online = fields[:4]
+        values = (parse_int(age, 5, 99), parse_hours(hours), parse_int(online, 0, 24), None)
+    else:
+        roles, members = fields[2:4]
+        values = (None, None, None, parse_int(members, 1, 1000))
+    role_mask = 0
+    for tag in parse_role_tags(roles):
+        role_mask |= ROLE_BITS[tag]
+    return values + (role_mask,)
+
+def store_parsed_application(conn, app_id, app_type, fields):
+    """Записывает разобранные поля заявки внутри транзакции conn."""
+    conn.execute(SQL_STORE_PARSED, parse_application(app_type, fields) + (APPLICATION_PARSE_VERSION, app_id))
+
 # Инициализация базы данных
 def init_db():
-    conn = sqlite3.connect('rust_bot.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        username TEXT,
-        registration_date TEXT
-    )''')
-    
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS applications (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        app_type TEXT,
-        team_type TEXT,
-        age TEXT,
-        hours TEXT,
-        role TEXT,
-        online TEXT,
-        discord TEXT,
-        clan_name TEXT,
-        leader_name TEXT,
-        required TEXT,
-        members_count TEXT,
-        date TEXT,
-        is_active INTEGER DEFAULT 1,
-        FOREIGN KEY (user_id) REFERENCES users (user_id)
-    )''')
-    
-    # Создаем таблицу для настроек, если ее нет
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS bot_settings (
-        key TEXT PRIMARY KEY,
-        value TEXT
-    )''')
-    
-    # Пытаемся загрузить сохраненное значение периода автоудаления
-    cursor.execute('SELECT value FROM bot_settings WHERE key = "auto_delete_days"')
-    result = cursor.fetchone()
+    def create_schema(conn):
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            registration_date TEXT,
+            registered_at INTEGER
+        )''')
+        
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS applications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            app_type TEXT,
+            team_type TEXT,
+            age TEXT,
+            hours TEXT,
+            role TEXT,
+            online TEXT,
+            discord TEXT,
+            clan_name TEXT,
+            leader_name TEXT,
+            required TEXT,
+            members_count TEXT,
+            date TEXT,
+            is_active INTEGER DEFAULT 1,
+            created_at INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )''')
+        
+        # Даты в формате "%d.%m.%Y %H:%M" не сортируются и не сравниваются как строки,
+        # поэтому рядом с ними храним epoch-секунды. Старые базы дополняем колонками,
+        # а сами значения заполняет migrate_dates_to_epoch() в фоне.
+        add_column_if_missing(cursor, 'users', 'registered_at', 'INTEGER')
+        add_column_if_missing(cursor, 'applications', 'created_at', 'INTEGER')
+        
+        # Числа и теги ролей, разобранные из текста заявки (parse_application).
+        # Исходный текст остается для показа; старые заявки разбирает backfill_parsed_fields()
+        for column in PARSED_APPLICATION_COLUMNS:
+            add_column_if_missing(cursor, 'applications', column, 'INTEGER')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_registered_at ON users (registered_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_applications_created_at ON applications (created_at)')
+        
+        for index_sql in APPLICATION_INDEXES:
+            cursor.execute(index_sql)
+        
+        # Счетчики заявок по (app_type, team_type, is_active) для админ-панели.
+        # Поддерживаются триггерами, поэтому всегда совпадают с таблицей заявок.
+        counters_exist = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'application_counters'"
+        ).fetchone()
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS application_counters (
+            app_type TEXT,
+            team_type TEXT,
+            is_active INTEGER,
+            total INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (app_type, team_type, is_active)
+        )''')
+        if not counters_exist:
+            cursor.execute('''
+            INSERT INTO application_counters (app_type, team_type, is_active, total)
+            SELECT app_type, IFNULL(team_type, ''), is_active, COUNT(*)
+            FROM applications
+            GROUP BY app_type, IFNULL(team_type, ''), is_active
+            ''')
+        for trigger_sql in APPLICATION_COUNTER_TRIGGERS:
+            cursor.execute(trigger_sql)
+        
+        # Полнотекстовый поиск по активным заявкам, поддерживается триггерами
+        fts_exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'applications_fts'"
+        ).fetchone()
+        cursor.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS applications_fts USING fts5(
+            {', '.join(APPLICATION_FTS_COLUMNS)}, tokenize = 'unicode61 remove_diacritics 2'
+        )''')
+        if not fts_exists:
+            cursor.execute(f'''
+            INSERT INTO applications_fts (rowid, {', '.join(APPLICATION_FTS_COLUMNS)})
+            SELECT id, {fts_values('applications')} FROM applications WHERE is_active = 1
+            ''')
+        for trigger_sql in APPLICATION_FTS_TRIGGERS:
+            cursor.execute(trigger_sql)
+        
+        # Создаем таблицу для настроек, если ее нет
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )''')
+        
+        # Очередь исходящих уведомлений: переживает перезапуск бота
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            not_before REAL NOT NULL DEFAULT 0
+        )''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_not_before ON outbox (not_before)')
+        
+        # Подписки на обязательные каналы, обновляются по событиям chat_member
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS channel_subscriptions (
+            channel TEXT,
+            user_id INTEGER,
+            is_member INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (channel, user_id)
+        )''')
+        
+        # Состояние диалогов и user_data, чтобы перезапуск не сбрасывал пользователей
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_states (
+            name TEXT,
+            conversation_key TEXT,
+            state INTEGER NOT NULL,
+            PRIMARY KEY (name, conversation_key)
+        )''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS persisted_user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        )''')
+        
+        # Пытаемся загрузить сохраненное значение периода автоудаления
+        cursor.execute('SELECT value FROM bot_settings WHERE key = "auto_delete_days"')
+        return cursor.fetchone()
+    
+    result = db.run_sync(create_schema)
     if result:
         global AUTO_DELETE_DAYS
         AUTO_DELETE_DAYS = int(result[0])
-    
-    conn.commit()
-    conn.close()
+
+# Фильтры полного списка заявок в админ-панели: статус, тип и пользователь.
+# Тип задается ключом TEAM_TYPES; клановые заявки хранятся с пустым team_type.
+ADMIN_STATUS_FILTERS = [None, 1, 0]
+ADMIN_TYPE_FILTERS = [None, 'duo', 'trio', 'quad', 'quad_plus', 'clan']
+
+def admin_type_filter_values(type_filter):
+    if type_filter == 'clan':
+        return 'clan', None
+    return 'teammate', type_filter
+
+def build_admin_apps_queries(admin_filters):
+    """Собирает запросы страницы админ-списка (первая, старее, новее) и их параметры."""
+    conditions, params = [], []
+    status = admin_filters.get('status')
+    if status is not None:
+        # Литерал, а не параметр: так SQLite может выбрать частичный индекс активных заявок
+        conditions.append(f'a.is_active = {int(status)}')
+    type_filter = admin_filters.get('type')
+    if type_filter is not None:
+        conditions.append('a.app_type = ? AND a.team_type IS ?')
+        params.extend(admin_type_filter_values(type_filter))
+    if admin_filters.get('user_id') is not None:
+        conditions.append('a.user_id = ?')
+        params.append(admin_filters['user_id'])
+    
+    base = '''
+    SELECT a.id, a.created_at, u.username, a.app_type, a.team_type, a.date, a.is_active 
+    FROM applications a
+    JOIN users u ON a.user_id = u.user_id
+    WHERE ''' + (' AND '.join(conditions) or '1') + ' '
+    return (base + LIST_FIRST, base + LIST_AFTER, base + LIST_BEFORE), tuple(params)
+
+# Фильтры списков заявок: (имя, подпись, варианты (значение, подпись)). Выбранные
+# фильтры передаются в callback_data кодом из одного символа на фильтр - номера варианта
+LIST_FILTERS = (
+    ('hours', '⏱ Часов', ((None, 'любое'), (500, 'от 500'), (1000, 'от 1000'), (3000, 'от 3000'),
+                         (5000, 'от 5000'), (10000, 'от 10000'))),
+    ('age', '🎂 Возраст', ((None, 'любой'), ((None, 17), 'до 18'), ((18, 25), '18–25'),
+                          ((26, 35), '26–35'), ((36, None), '36+'))),
+    ('online', '⏳ Онлайн', ((None, 'любой'), (2, 'от 2 ч'), (4, 'от 4 ч'), (6, 'от 6 ч'), (8, 'от 8 ч'))),
+    ('role', '🎮 Роль', ((None, 'любая'),) + tuple(ROLE_LABELS.items())),
+)
+# Кланы фильтруются только по тем, кого они ищут
+CLAN_LIST_FILTERS = {'role': '🔍 Требуются'}
+NO_FILTERS = (0,) * len(LIST_FILTERS)
+FILTER_CODE_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+def filter_code(filters):
+    return ''.join(FILTER_CODE_DIGITS[i] for i in filters)
+
+def parse_filter_code(code):
+    """Номера вариантов фильтров из кода; неизвестный код означает "без фильтров"."""
+    filters = tuple(FILTER_CODE_DIGITS.find(char) for char in code)
+    if len(filters) != len(LIST_FILTERS) or any(
+        not 0 <= i < len(options) for i, (_, _, options) in zip(filters, LIST_FILTERS)
+    ):
+        return NO_FILTERS
+    return filters
+
+def list_filter_labels(app_type):
+    """Подписи фильтров, применимых к категории, по позициям кода; None - фильтр не применяется."""
+    if app_type == 'teammate':
+        return [label for _, label, _ in LIST_FILTERS]
+    return [CLAN_LIST_FILTERS.get(name) for name, _, _ in LIST_FILTERS]
+
+def selected_list_filters(app_type, filters):
+    """Выбранные фильтры, применимые к категории: [(имя, значение, описание)]."""
+    return [
+        (name, options[i][0], f"{label}: {options[i][1]}")
+        for (name, _, options), label, i in zip(LIST_FILTERS, list_filter_labels(app_type), filters)
+        if i and label is not None
+    ]
+
+_FILTERED_LIST_COLUMNS = {
+    'teammate': 'a.age, a.hours, a.role, a.online, a.discord, a.date',
+    'clan': 'a.clan_name, a.leader_name, a.required, a.members_count, a.discord, a.date',
+}
+
+def build_filtered_list_queries(app_type, team_type, filters):
+    """Собирает запросы страницы списка категории с фильтрами (первая, старее, новее),
+    запрос количества и общие параметры. Категория и все условия покрываются
+    idx_applications_parsed, поэтому страница - обход диапазона индекса в порядке списка."""
+    # Клановые заявки хранятся без team_type, как и в category_key()
+    conditions = ['a.app_type = ?', 'a.team_type IS ?']
+    params = [app_type, team_type if app_type == 'teammate' else None]
+    for name, value, _ in selected_list_filters(app_type, filters):
+        if name == 'hours':
+            conditions.append('a.hours_played >= ?')
+            params.append(value)
+        elif name == 'online':
+            conditions.append('a.online_hours >= ?')
+            params.append(value)
+        elif name == 'age':
+            low, high = value
+            if low is not None:
+                conditions.append('a.age_years >= ?')
+                params.append(low)
+            if high is not None:
+                conditions.append('a.age_years <= ?')
+                params.append(high)
+        elif name == 'role':
+            # Универсал подходит под любую роль
+            conditions.append('a.role_mask & ? != 0')
+            params.append(ROLE_BITS[value] | ROLE_BITS['universal'])
+    
+    where = 'a.is_active = 1 AND ' + ' AND '.join(conditions)
+    base = f'''
+    SELECT a.id, a.created_at, u.username, {_FILTERED_LIST_COLUMNS['teammate' if app_type == 'teammate' else 'clan']} 
+    FROM applications a
+    LEFT JOIN users u ON a.user_id = u.user_id
+    WHERE {where} '''
+    count_sql = f'SELECT COUNT(*) FROM applications a WHERE {where}'
+    return (base + LIST_FIRST, base + LIST_AFTER, base + LIST_BEFORE), count_sql, tuple(params)
+
+async def count_admin_applications(admin_filters):
+    status = admin_filters.get('status')
+    type_filter = admin_filters.get('type')
+    if admin_filters.get('user_id') is not None:
+        # Заявок одного пользователя немного, считаем их по индексу
+        conditions, params = ['user_id = ?'], [admin_filters['user_id']]
+        if status is not None:
+            conditions.append('is_active = ?')
+            params.append(status)
+        if type_filter is not None:
+            conditions.append('app_type = ? AND team_type IS ?')
+            params.extend(admin_type_filter_values(type_filter))
+        sql = 'SELECT COUNT(*) FROM applications WHERE ' + ' AND '.join(conditions)
+    else:
+        conditions, params = [], []
+        if status is not None:
+            conditions.append('is_active = ?')
+            params.append(status)
+        if type_filter is not None:
+            app_type, team_type = admin_type_filter_values(type_filter)
+            conditions.append('app_type = ? AND team_type = ?')
+            params.extend((app_type, team_type or ''))
+        sql = 'SELECT IFNULL(SUM(total), 0) FROM application_counters WHERE ' + (' AND '.join(conditions) or '1')
+    return (await db.fetchone(sql, tuple(params)))[0]
+
+# Зарегистрированные запросы и примеры параметров для проверки планов при запуске
+QUERY_PLAN_CHECKS = {
+    'active_apps': (SQL_ACTIVE_APPS, ()),
+    'active_app': (SQL_ACTIVE_APP, (0,)),
+    'user_active_apps': (SQL_USER_ACTIVE_APPS, (0,)),
+    'deactivate_user_apps': (SQL_DEACTIVATE_USER_APPS, (0,)),
+    'expire_apps': (SQL_EXPIRE_APPS, (0,)),
+    'outbox_due': (SQL_OUTBOX_DUE, (0, OUTBOX_BATCH_SIZE)),
+    'outbox_next_due': (SQL_OUTBOX_NEXT_DUE, (0,)),
+    'parse_backfill': (SQL_PARSE_BACKFILL, (0, APPLICATION_PARSE_VERSION, PARSE_BACKFILL_BATCH_SIZE)),
+}
+
+# Все варианты админ-списка: без фильтров и с каждым фильтром по отдельности
+for _admin_filters in ({}, {'status': 1}, {'status': 0}, {'type': 'duo'}, {'type': 'clan'}, {'user_id': 0}):
+    _admin_queries, _admin_params = build_admin_apps_queries(_admin_filters)
+    _admin_name = 'admin_apps_' + ('_'.join(f'{k}_{v}' for k, v in _admin_filters.items()) or 'all')
+    QUERY_PLAN_CHECKS[_admin_name] = (_admin_queries[0], _admin_params + (10,))
+    QUERY_PLAN_CHECKS[_admin_name + '_after'] = (_admin_queries[1], _admin_params + (0, 0, 10))
+
+# Списки с фильтрами: все фильтры тиммейтов сразу и фильтр по роли у кланов
+for _app_type, _team_type in (('teammate', 'duo'), ('clan', None)):
+    _list_queries, _list_count, _list_params = build_filtered_list_queries(_app_type, _team_type, (1, 2, 1, 3))
+    QUERY_PLAN_CHECKS[f'filtered_list_{_app_type}'] = (_list_queries[0], _list_params + (10,))
+    QUERY_PLAN_CHECKS[f'filtered_list_{_app_type}_after'] = (_list_queries[1], _list_params + (0, 0, 10))
+    QUERY_PLAN_CHECKS[f'filtered_list_{_app_type}_count'] = (_list_count, _list_params)
+
+def check_query_plans():
+    """Предупреждает, если какой-то из зарегистрированных запросов читает таблицу целиком."""
+    def explain_all(conn):
+        return {
+            name: [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+            for name, (sql, params) in QUERY_PLAN_CHECKS.items()
+        }
+    
+    for name, plan in db.run_sync(explain_all).items():
+        for step in plan:
+            # "SCAN a USING INDEX ..." - упорядоченный обход индекса, это нормально;
+            # "SCAN a" без индекса - полный перебор таблицы
+            if step.startswith('SCAN') and 'USING' not in step:
+                logger.warning(f"Запрос {name} выполняется полным сканированием: {step}")
+            elif 'TEMP B-TREE' in step:
+                logger.warning(f"Запрос {name} сортирует результат без индекса: {step}")
 
 init_db()
+check_query_plans()
+
+def parse_legacy_date(value):
+    try:
+        return int(datetime.strptime(value, "%d.%m.%Y %H:%M").timestamp())
+    except (TypeError, ValueError):
+        return None
+
+async def migrate_dates_to_epoch(context: CallbackContext):
+    """Переводит строковые даты в epoch-секунды небольшими пачками, не блокируя бота."""
+    for table, id_column, text_column, epoch_column in (
+        ('applications', 'id', 'date', 'created_at'),
+        ('users', 'user_id', 'registration_date', 'registered_at'),
+    ):
+        migrated = 0
+        while True:
+            def migrate_batch(conn):
+                rows = conn.execute(
+                    f'SELECT {id_column}, {text_column} FROM {table} WHERE {epoch_column} IS NULL LIMIT ?',
+                    (DATE_MIGRATION_BATCH_SIZE,)
+                ).fetchall()
+                now = int(time.time())
+                values = []
+                for row_id, text_value in rows:
+                    epoch = parse_legacy_date(text_value)
+                    if epoch is None:
+                        logger.warning(f"Не удалось разобрать дату {text_value!r} в {table} ({row_id}), используется текущее время")
+                        epoch = now
+                    values.append((epoch, row_id))
+                conn.executemany(
+                    f'UPDATE {table} SET {epoch_column} = ? WHERE {id_column} = ?',
+                    values
+                )
+                return len(rows)
+            
+            count = await db.transaction(migrate_batch)
+            migrated += count
+            if count < DATE_MIGRATION_BATCH_SIZE:
+                break
+            # Отдаем поток-писатель обработчикам между пачками
+            await asyncio.sleep(0.05)
+        
+        if migrated:
+            logger.info(f"Миграция дат: в таблице {table} обновлено {migrated} строк")
+            if table == 'applications':
+                # Ключи сортировки в индексе активных заявок изменились
+                await active_apps.reload_until_consistent()
+
+async def backfill_parsed_fields(context: CallbackContext):
+    """Разбирает поля заявок, сохраненных до появления разбора или прошлой его версией."""
+    last_id, parsed = 0, 0
+    while True:
+        def parse_batch(conn):
+            rows = conn.execute(SQL_PARSE_BACKFILL, (last_id, APPLICATION_PARSE_VERSION, PARSE_BACKFILL_BATCH_SIZE)).fetchall()
+            for app_id, app_type, age, hours, role, online, required, members_count in rows:
+                fields = (age, hours, role, online) if app_type == 'teammate' else (None, None, required, members_count)
+                store_parsed_application(conn, app_id, app_type, fields)
+            return rows[-1][0] if rows else last_id, len(rows)
+        
+        last_id, count = await db.transaction(parse_batch)
+        parsed += count
+        if count < PARSE_BACKFILL_BATCH_SIZE:
+            break
+        # Отдаем поток-писатель обработчикам между пачками
+        await asyncio.sleep(0.05)
+    
+    if parsed:
+        logger.info(f"Разобраны поля {parsed} заявок")
+        # В строках индекса активных заявок появились разобранные значения
+        await active_apps.reload_until_consistent()
 
 # Инициализация файла пользователей
 def init_users_file():
@@ -111,77 +779,1203 @@ def init_users_file():
             writer = csv.writer(file)
             writer.writerow(['user_id', 'username', 'registration_date'])
 
-init_users_file()
+init_users_file()
+
+# Утилиты
+def create_button(text, callback_data):
+    return InlineKeyboardButton(text, callback_data=callback_data)
+
+# Кнопки с параметрами передают '<действие>:<параметр>:...'. По действию
+# обработчик находится одним поиском в словаре (см. CHOOSING_CALLBACKS)
+CALLBACK_SEPARATOR = ':'
+
+def callback_data(action, *args):
+    return CALLBACK_SEPARATOR.join((action, *map(str, args)))
+
+def callback_args(data):
+    return data.split(CALLBACK_SEPARATOR)[1:]
+
+ADMIN_ID_SET = frozenset(int(admin_id) for admin_id in ADMIN_IDS.split(','))
+
+def is_admin(user_id):
+    return user_id in ADMIN_ID_SET
+
+# Статические меню собираются один раз при запуске. InlineKeyboardMarkup неизменяем,
+# поэтому один и тот же объект можно отдавать во всех ответах
+_MAIN_MENU_ROWS = (
+    (create_button("🔍 Найти Тиммейта", 'find_teammate'),),
+    (create_button("🏰 Клан", 'find_clan'),),
+    (create_button("🔎 Поиск по заявкам", 'search'),),
+    (create_button("❌ Удалиться из поиска", 'remove_from_search'),),
+    (create_button("📚 Гайд по боту", 'guide'),),
+)
+MAIN_MENU_KEYBOARD = InlineKeyboardMarkup(_MAIN_MENU_ROWS)
+ADMIN_MAIN_MENU_KEYBOARD = InlineKeyboardMarkup(_MAIN_MENU_ROWS + ((create_button("👑 Админу", 'admin_panel'),),))
+
+TEAMMATE_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [create_button("👥 Duo", 'duo')],
+    [create_button("👥👥 Trio", 'trio')],
+    [create_button("👥👥👥 Quad", 'quad')],
+    [create_button("👥👥👥+ Quad+", 'quad_plus')],
+    [create_button("🔙 Назад в главное меню", 'back_to_main')]
+])
+
+CLAN_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [create_button("📝 Подать Заявку", 'apply_clan')],
+    [create_button("📋 Список Заявок", 'list_clan')],
+    [create_button("✏️ Мои заявки", 'my_apps_clan')],
+    [create_button("🔙 Назад в главное меню", 'back_to_main')]
+])
+
+# Заголовки меню типов команд; клавиатуры у них отличаются только типом в callback_data
+TEAM_MENU_TITLES = {
+    'duo': "👥 Выберите действие для Duo:",
+    'trio': "👥👥 Выберите действие для Trio:",
+    'quad': "👥👥👥 Выберите действие для Quad:",
+    'quad_plus': "👥👥👥+ Выберите действие для Quad+:",
+}
+
+def build_team_menu_keyboard(team_type):
+    return InlineKeyboardMarkup([
+        [create_button("📝 Подать Заявку", f'apply_{team_type}')],
+        [create_button("📋 Список Заявок", f'list_{team_type}')],
+        [create_button("✏️ Мои заявки", f'my_apps_{team_type}')],
+        [create_button("🔙 Назад", 'back_to_teammate')],
+        [create_button("🏠 Главное меню", 'back_to_main')]
+    ])
+
+TEAM_MENUS = {
+    team_type: (title, build_team_menu_keyboard(team_type))
+    for team_type, title in TEAM_MENU_TITLES.items()
+}
+
+GUIDE_TEXT = (
+    "📚 Гайд по боту:\n\n"
+    "1. Используйте кнопки для навигации\n"
+    "2. Заполняйте заявки полностью и правдиво\n"
+    "3. Для выхода используйте 'Удалиться из поиска'\n"
+    "4. Не указывайте личную информацию кроме Discord\n"
+    "5. Будьте вежливы с другими игроками\n"
+    "6. Если что-то не работает, удалите чат и заново войдите\n"
+    "7. Для поиска по ролям и кланам используйте кнопку «Поиск» или команду /search\n"
+    "8. Кнопка «Лучшие для меня» в списке тиммейтов сортирует заявки по сходству с вашей\n\n"
+    "Приятной игры! 🎮"
+)
+
+BACK_TO_MAIN_KEYBOARD = InlineKeyboardMarkup([[create_button("🔙 Назад в главное меню", 'back_to_main')]])
+
+ADMIN_PANEL_KEYBOARD = InlineKeyboardMarkup([
+    [create_button("📋 Полный список заявок", 'admin_all_apps')],
+    [create_button("🕒 Изменить период автоудаления", 'admin_set_autodelete')],
+    [create_button("⚠️ Список жалоб", 'admin_complaints')],
+    [create_button("🏆 Конкурсы", 'admin_contests')],
+    [create_button("🔙 Назад", 'back_to_main')]
+])
+
+AUTODELETE_KEYBOARD = InlineKeyboardMarkup([
+    [create_button("1 день", callback_data('admin_set_days', 1))],
+    [create_button("2 дня", callback_data('admin_set_days', 2))],
+    [create_button("3 дня", callback_data('admin_set_days', 3))],
+    [create_button("4 дня", callback_data('admin_set_days', 4))],
+    [create_button("5 дней", callback_data('admin_set_days', 5))],
+    [create_button("7 дней", callback_data('admin_set_days', 7))],
+    [create_button("🔙 Назад", 'admin_panel')]
+])
+
+WELCOME_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Rustric", url=f"https://t.me/{CHANNEL_RUSTRIC[1:]}")],
+    [InlineKeyboardButton("Дэнзи", url=f"https://t.me/{CHANNEL_DENZI[1:]}")]
+])
+
+# Готовые страницы списков: категория -> {(page, direction, cursor): (page, текст, клавиатура)}
+rendered_pages = {}
+
+def category_key(app_type, team_type):
+    # Клановые заявки не делятся по team_type
+    return (app_type, team_type if app_type == 'teammate' else None)
+
+def invalidate_category(app_type, team_type):
+    """Вызывается всеми путями, которые меняют заявки категории."""
+    rendered_pages.pop(category_key(app_type, team_type), None)
+
+def sql_page_fetcher(queries, params):
+    """Загрузчик страниц для fetch_keyset_page из запросов (первая, старее, новее) с общими параметрами."""
+    sql_first, sql_after, sql_before = queries
+    
+    async def fetch(direction, cursor, limit):
+        if direction == 'before':
+            return await db.fetchall(sql_before, params + cursor + (limit,))
+        if direction == 'after':
+            return await db.fetchall(sql_after, params + cursor + (limit,))
+        return await db.fetchall(sql_first, params + (limit,))
+    
+    return fetch
+
+async def fetch_keyset_page(fetch, per_page, page=0, direction=None, cursor=None):
+    """Загружает страницу по ключу (created_at, id) из первых двух колонок выборки.
+    
+    fetch(direction, cursor, limit) возвращает строки первой страницы (direction=None),
+    строки старее cursor по убыванию ('after') или новее cursor по возрастанию ('before').
+    Возвращает (строки, номер страницы, есть ли страница новее, есть ли страница старее).
+    """
+    # Берем на одну строку больше, чтобы знать, есть ли следующая страница
+    rows = []
+    has_newer = has_older = False
+    if direction == 'before':
+        rows = await fetch('before', cursor, per_page + 1)
+        has_newer = len(rows) > per_page
+        rows = rows[:per_page][::-1]
+        has_older = True
+        page = max(page - 1, 0)
+        if not has_newer:
+            # Дошли до начала списка - показываем полную первую страницу
+            rows = []
+    elif direction == 'after':
+        rows = await fetch('after', cursor, per_page + 1)
+        has_older = len(rows) > per_page
+        rows = rows[:per_page]
+        has_newer = True
+        page += 1
+    
+    # Первая страница, а также случай, когда строки на странице успели удалить
+    if not rows:
+        rows = await fetch(None, None, per_page + 1)
+        has_older = len(rows) > per_page
+        rows = rows[:per_page]
+        has_newer = False
+        page = 0
+    
+    return rows, page, has_newer, has_older
+
+def hours_bucket(hours):
+    """Диапазон часов для подбора тиммейтов: индекс в MATCH_HOURS_BUCKETS или None, если часы не разобраны."""
+    return None if hours is None else bisect.bisect_right(MATCH_HOURS_BUCKETS, hours)
+
+def neighbour_hours_buckets(bucket):
+    # Заявки без разобранных часов подходят к любому диапазону, и наоборот
+    if bucket is None:
+        return [None, *range(len(MATCH_HOURS_BUCKETS) + 1)]
+    return [None, *range(max(bucket - 1, 0), min(bucket + 1, len(MATCH_HOURS_BUCKETS)) + 1)]
+
+def match_scorer(row):
+    """Функция оценки заявок тиммейтов (строк SQL_ACTIVE_APPS) против row от 0 до 1.
+    Поле, не разобранное хотя бы у одной стороны, дает нейтральные 0.5."""
+    age, hours, online, _, roles = row[16:21]
+    # Опыт сравнивается в разах: 500 и 1000 часов так же близки, как 5000 и 10000
+    hours_log = None if hours is None else math.log10(hours + 1)
+    universal = ROLE_BITS['universal']
+    w_hours, w_online, w_age, w_roles = (MATCH_WEIGHTS[name] for name in ('hours', 'online', 'age', 'roles'))
+    s_hours, s_online, s_age = (MATCH_SCALES[name] for name in ('hours', 'online', 'age'))
+    
+    def score(other):
+        other_age, other_hours, other_online, _, other_roles = other[16:21]
+        total = 0.0
+        if hours_log is None or other_hours is None:
+            total += w_hours * 0.5
+        else:
+            total += w_hours * max(1 - abs(hours_log - math.log10(other_hours + 1)) / s_hours, 0)
+        if online is None or other_online is None:
+            total += w_online * 0.5
+        else:
+            total += w_online * max(1 - abs(online - other_online) / s_online, 0)
+        if age is None or other_age is None:
+            total += w_age * 0.5
+        else:
+            total += w_age * max(1 - abs(age - other_age) / s_age, 0)
+        # Команде полезнее разные роли; универсал подходит к любой
+        if roles and other_roles and roles == other_roles and not roles & universal:
+            total += w_roles * 0.5
+        elif roles and other_roles:
+            total += w_roles
+        else:
+            total += w_roles * 0.5
+        return total
+    
+    return score
+
+class CategoryFeatures:
+    """Матрица признаков активных заявок тиммейтов одного team_type для сортировки "лучшие для меня".
+
+    Строка - (log10 часов, онлайн, возраст) с NaN вместо неразобранных полей, рядом лежат
+    id заявки, автор и маска ролей. Новая заявка пишется в конец, удаленную замещает
+    последняя строка, так что изменения заявок не перестраивают матрицу. Нужен NumPy.
+    """
+
+    COLUMNS = ('hours', 'online', 'age')
+
+    def __init__(self, capacity=64):
+        self.size = 0
+        self._values = np.empty((capacity, len(self.COLUMNS)))
+        self._ids = np.empty(capacity, dtype=np.int64)
+        self._users = np.empty(capacity, dtype=np.int64)
+        self._roles = np.empty(capacity, dtype=np.int64)
+        self._positions = {}
+        self._weights = np.array([MATCH_WEIGHTS[name] for name in self.COLUMNS])
+        self._scales = np.array([MATCH_SCALES[name] for name in self.COLUMNS], dtype=float)
+
+    @staticmethod
+    def features(row):
+        age, hours, online = row[16], row[17], row[18]
+        return (
+            np.nan if hours is None else math.log10(hours + 1),
+            np.nan if online is None else online,
+            np.nan if age is None else age,
+        )
+
+    def add(self, row):
+        if self.size == len(self._ids):
+            self._grow()
+        i = self.size
+        self._values[i] = self.features(row)
+        self._ids[i], self._users[i], self._roles[i] = row[0], row[2], row[20] or 0
+        self._positions[row[0]] = i
+        self.size += 1
+
+    def _grow(self):
+        capacity = len(self._ids) * 2
+        for name in ('_values', '_ids', '_users', '_roles'):
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def remove(self, app_id):
+        i = self._positions.pop(app_id)
+        last = self.size - 1
+        if i != last:
+            self._values[i] = self._values[last]
+            self._ids[i], self._users[i], self._roles[i] = self._ids[last], self._users[last], self._roles[last]
+            self._positions[int(self._ids[i])] = i
+        self.size = last
+
+    def ranked(self, own, offset, limit):
+        """Те же оценки, что у match_scorer(own), одним проходом по матрице.
+        Возвращает (число заявок без заявок автора own, [(оценка, app_id)] для среза
+        [offset, offset + limit)), лучшие первыми, при равной оценке - новее."""
+        keep = np.flatnonzero(self._users[:self.size] != own[2])
+        closeness = 1 - np.abs(self._values[keep] - self.features(own)) / self._scales
+        # NaN - поле не разобрано хотя бы у одной стороны
+        scores = np.where(np.isnan(closeness), 0.5, np.maximum(closeness, 0)) @ self._weights
+        own_roles = own[20] or 0
+        roles = self._roles[keep]
+        if own_roles:
+            neutral = roles == 0
+            if not own_roles & ROLE_BITS['universal']:
+                neutral |= roles == own_roles
+            scores += MATCH_WEIGHTS['roles'] * np.where(neutral, 0.5, 1.0)
+        else:
+            scores += MATCH_WEIGHTS['roles'] * 0.5
+        # Округление убирает разницу в последних битах с match_scorer, и равные оценки упорядочиваются по id
+        scores = np.round(scores, MATCH_SCORE_DIGITS)
+        ids = self._ids[keep]
+        order = np.lexsort((-ids, -scores))[offset:offset + limit]
+        return len(keep), [(float(scores[i]), int(ids[i])) for i in order]
+
+# Активные заявки в памяти: списки категорий, заявки пользователя и проверки
+# "есть ли заявки" читаются отсюда, а не из базы
+class ActiveApplicationIndex:
+    """Строки SQL_ACTIVE_APPS по id, отсортированные ключи (created_at, id) по категориям,
+    id заявок каждого пользователя, корзины заявок тиммейтов для подбора и, при наличии NumPy,
+    матрицы признаков тиммейтов для сортировки "лучшие для меня".
+    Обновляется теми же обработчиками, что пишут в таблицу applications, сразу после их транзакций."""
+
+    def __init__(self):
+        self._apps = {}
+        self._by_category = {}
+        self._by_user = {}
+        # (team_type, диапазон часов) -> id заявок в порядке добавления (dict как упорядоченное множество)
+        self._by_match_bucket = {}
+        # team_type -> CategoryFeatures, только с NumPy
+        self._features = {}
+        # Увеличивается при каждом изменении, чтобы сверка не затерла свежие данные старым снимком
+        self._version = 0
+
+    def load(self):
+        self._reset(db.run_sync(lambda conn: conn.execute(SQL_ACTIVE_APPS).fetchall()))
+        logger.info(f"Загружено активных заявок: {len(self._apps)}")
+
+    def _reset(self, rows):
+        self._apps, self._by_category, self._by_user, self._by_match_bucket = {}, {}, {}, {}
+        self._features = {}
+        # В порядке (created_at, id) ключи категорий сразу отсортированы, а корзины подбора идут от старых к новым
+        for row in sorted(rows, key=self._sort_key):
+            self._add(row)
+        rendered_pages.clear()
+        self._version += 1
+
+    @staticmethod
+    def _sort_key(row):
+        # Строки без created_at (до миграции дат) SQLite тоже ставит в конец списка
+        return (row[1] or 0, row[0])
+
+    def _add(self, row, keep_sorted=False):
+        app_id, user_id, app_type, team_type = row[0], row[2], row[3], row[4]
+        self._apps[app_id] = row
+        keys = self._by_category.setdefault(category_key(app_type, team_type), [])
+        if keep_sorted:
+            bisect.insort(keys, self._sort_key(row))
+        else:
+            keys.append(self._sort_key(row))
+        self._by_user.setdefault(user_id, set()).add(app_id)
+        match_key = self._match_key(row)
+        if match_key is not None:
+            self._by_match_bucket.setdefault(match_key, {})[app_id] = None
+            if np is not None:
+                self._features.setdefault(team_type, CategoryFeatures()).add(row)
+
+    def _remove(self, app_id):
+        row = self._apps.pop(app_id, None)
+        if row is None:
+            return
+        keys = self._by_category[category_key(row[3], row[4])]
+        keys.pop(bisect.bisect_left(keys, self._sort_key(row)))
+        user_apps = self._by_user[row[2]]
+        user_apps.discard(app_id)
+        if not user_apps:
+            del self._by_user[row[2]]
+        match_key = self._match_key(row)
+        if match_key is not None:
+            self._by_match_bucket[match_key].pop(app_id, None)
+            if np is not None:
+                self._features[row[4]].remove(app_id)
+
+    @staticmethod
+    def _match_key(row):
+        if row[3] != 'teammate':
+            return None
+        return (row[4], hours_bucket(row[17]))
+
+    def apply(self, app_id, row):
+        """Записывает состояние заявки после транзакции: row из SQL_ACTIVE_APP или None."""
+        self._remove(app_id)
+        if row is not None:
+            self._add(row, keep_sorted=True)
+        self._version += 1
+
+    def remove(self, app_id):
+        self._remove(app_id)
+        self._version += 1
+
+    def __contains__(self, app_id):
+        return app_id in self._apps
+
+    def count(self, app_type, team_type):
+        return len(self._by_category.get(category_key(app_type, team_type), ()))
+
+    def has_user_apps(self, user_id):
+        return user_id in self._by_user
+
+    @staticmethod
+    def _listing_row(row):
+        # Колонки строки списка: id, created_at, username, поля заявки, discord, date
+        if row[3] == 'teammate':
+            return (row[0], row[1], row[5]) + row[6:12]
+        return (row[0], row[1], row[5]) + row[12:16] + row[10:12]
+
+    def page_fetcher(self, app_type, team_type):
+        """Загрузчик страниц категории для fetch_keyset_page."""
+        keys = self._by_category.get(category_key(app_type, team_type), [])
+        
+        async def fetch(direction, cursor, limit):
+            if direction == 'before':
+                start = bisect.bisect_right(keys, cursor)
+                selected = keys[start:start + limit]
+            elif direction == 'after':
+                end = bisect.bisect_left(keys, cursor)
+                selected = keys[max(end - limit, 0):end][::-1]
+            else:
+                selected = keys[-limit:][::-1]
+            return [self._listing_row(self._apps[app_id]) for _, app_id in selected]
+        
+        return fetch
+
+    def entries(self, app_ids):
+        """Строки списка для тех из app_ids, что еще активны: [(app_type, team_type, строка)]."""
+        return [
+            (row[3], row[4], self._listing_row(row))
+            for row in map(self._apps.get, app_ids) if row is not None
+        ]
+
+    def match_candidates(self, row, per_bucket=MATCH_CANDIDATES_PER_BUCKET):
+        """Заявки тиммейтов того же team_type из соседних с row диапазонов часов,
+        не больше per_bucket новейших из каждого диапазона."""
+        match_key = self._match_key(row)
+        if match_key is None:
+            return []
+        team_type, bucket = match_key
+        candidates = []
+        for neighbour in neighbour_hours_buckets(bucket):
+            app_ids = self._by_match_bucket.get((team_type, neighbour))
+            if app_ids:
+                candidates.extend(self._apps[app_id] for app_id in itertools.islice(reversed(app_ids), per_bucket))
+        return candidates
+
+    def own_teammate_app(self, user_id, team_type):
+        """Самая новая активная заявка пользователя в категории тиммейтов (строка SQL_ACTIVE_APPS) или None."""
+        rows = [
+            self._apps[app_id] for app_id in self._by_user.get(user_id, ())
+            if self._apps[app_id][3] == 'teammate' and self._apps[app_id][4] == team_type
+        ]
+        return max(rows, key=self._sort_key, default=None)
+
+    def ranked(self, own, offset, limit):
+        """Заявки категории own, кроме заявок его автора, по убыванию match_scorer(own),
+        при равной оценке новее первыми. Возвращает (число заявок, [(оценка, строка списка)])
+        для среза [offset, offset + limit)."""
+        team_type = own[4]
+        if np is not None:
+            features = self._features.get(team_type)
+            if features is None:
+                return 0, []
+            total, top = features.ranked(own, offset, limit)
+        else:
+            scorer = match_scorer(own)
+            scored = [
+                (round(scorer(row), MATCH_SCORE_DIGITS), row[0])
+                for row in (self._apps[app_id] for _, app_id in self._by_category.get(category_key('teammate', team_type), ()))
+                if row[2] != own[2]
+            ]
+            total, top = len(scored), heapq.nlargest(offset + limit, scored)[offset:]
+        return total, [(score, self._listing_row(self._apps[app_id])) for score, app_id in top]
+
+    def user_apps(self, user_id, app_type, team_type):
+        """Заявки пользователя в категории, новые первыми:
+        (id, поля заявки..., discord, date) в порядке формы заявки."""
+        key = category_key(app_type, team_type)
+        rows = [
+            self._apps[app_id] for app_id in self._by_user.get(user_id, ())
+            if category_key(self._apps[app_id][3], self._apps[app_id][4]) == key
+        ]
+        rows.sort(key=self._sort_key, reverse=True)
+        if app_type == 'teammate':
+            return [(row[0],) + row[6:12] for row in rows]
+        return [(row[0],) + row[12:16] + row[10:12] for row in rows]
+
+    async def reload(self):
+        """Сверяет индекс с базой и перестраивает его при расхождении.
+        Возвращает True, если индекс совпадал, False, если был перестроен,
+        и None, если пока шло чтение, обработчики изменили заявки."""
+        version = self._version
+        rows = await db.fetchall(SQL_ACTIVE_APPS)
+        if version != self._version:
+            return None
+        if {row[0]: row for row in rows} == self._apps:
+            return True
+        self._reset(rows)
+        return False
+
+    async def reload_until_consistent(self, retry_delay=1):
+        """reload(), повторяемый, пока чтение не пройдет без параллельных изменений.
+        Для разовых задач, меняющих заявки в базе в обход индекса: до периодической
+        сверки индекс иначе отдавал бы старые строки."""
+        while (consistent := await self.reload()) is None:
+            await asyncio.sleep(retry_delay)
+        return consistent
+
+active_apps = ActiveApplicationIndex()
+active_apps.load()
+
+async def check_active_apps(context: CallbackContext):
+    """Периодическая сверка индекса активных заявок с базой."""
+    try:
+        consistent = await active_apps.reload()
+    except Exception as e:
+        logger.error(f"Ошибка при сверке индекса заявок: {e}")
+        return
+    if consistent is False:
+        logger.warning("Индекс активных заявок расходился с базой и был перестроен")
+
+def parse_page_callback(data):
+    """Разбирает '<действие>:<page>:<created_at>:<id>' в номер страницы и ключ границы."""
+    page, created_at, row_id = callback_args(data)
+    return int(page), (int(created_at), int(row_id))
+
+# Реестр известных пользователей: проверка "новый ли пользователь" идет по множеству в памяти,
+# а новые записи копятся и раз в USERS_FLUSH_INTERVAL секунд пачкой уходят в базу и в CSV
+class UserRegistry:
+    def __init__(self):
+        self.known_ids = set()
+        self._pending = []
+
+    def load(self):
+        rows = db.run_sync(lambda conn: conn.execute('SELECT user_id FROM users').fetchall())
+        self.known_ids = {row[0] for row in rows}
+        logger.info(f"Загружено пользователей: {len(self.known_ids)}")
+
+    def add(self, user_id, username):
+        if user_id in self.known_ids:
+            return False
+        self.known_ids.add(user_id)
+        now = datetime.now()
+        self._pending.append((user_id, username, now.strftime("%d.%m.%Y %H:%M"), int(now.timestamp())))
+        return True
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        try:
+            await db.transaction(lambda conn: conn.executemany(
+                'INSERT OR IGNORE INTO users (user_id, username, registration_date, registered_at) VALUES (?, ?, ?, ?)',
+                batch
+            ))
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении пользователей: {e}")
+            self._pending[:0] = batch
+            return
+        
+        # Выгрузка в CSV только дописывает новые строки в конец файла
+        try:
+            await asyncio.to_thread(self._append_to_csv, batch)
+        except OSError as e:
+            logger.error(f"Ошибка при записи в {USERS_FILE}: {e}")
+
+    @staticmethod
+    def _append_to_csv(batch):
+        with open(USERS_FILE, mode='a', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerows((user_id, username, registration_date) for user_id, username, registration_date, _ in batch)
+
+user_registry = UserRegistry()
+user_registry.load()
+
+def save_user(user_id, username):
+    user_registry.add(user_id, username)
+
+async def flush_users(context: CallbackContext):
+    await user_registry.flush()
+
+class TokenBucket:
+    """Ограничитель частоты: не больше rate операций в секунду с запасом capacity."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+def retry_after_seconds(error):
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+# Рассылка уведомлений пользователям
+class Broadcaster:
+    """Отправляет сообщения из таблицы outbox параллельно, соблюдая лимиты Telegram.
+    
+    Сообщение удаляется из outbox только после успешной отправки, поэтому
+    после перезапуска бота неотправленные уведомления досылаются.
+    """
+
+    def __init__(self, global_rate=BROADCAST_GLOBAL_RATE, concurrency=BROADCAST_CONCURRENCY):
+        self._bucket = TokenBucket(global_rate, global_rate)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._chat_next_send = {}
+        self._in_flight = set()
+        self._delivered = []
+        self._tasks = set()
+        self._loop_task = None
+        self._running = False
+        self._bot = None
+
+    @staticmethod
+    def enqueue_in(conn, messages):
+        """Добавляет сообщения (chat_id, text, parse_mode) в очередь внутри транзакции conn."""
+        conn.executemany('INSERT INTO outbox (chat_id, text, parse_mode) VALUES (?, ?, ?)', messages)
+
+    async def enqueue(self, messages):
+        await db.transaction(lambda conn: self.enqueue_in(conn, messages))
+        self.wake()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def start(self, bot):
+        self._bot = bot
+        self._running = True
+        self._loop_task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._loop_task:
+            # Флаг нужен помимо cancel(): wait_for в Python 3.11 теряет отмену,
+            # если _wakeup срабатывает одновременно с ней
+            self._running = False
+            self.wake()
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+            self._loop_task = None
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+        await self._flush_delivered()
+
+    async def _run(self):
+        while self._running:
+            self._wakeup.clear()
+            dispatched = 0
+            try:
+                await self._flush_delivered()
+                rows = await db.fetchall(SQL_OUTBOX_DUE, (time.time(), OUTBOX_BATCH_SIZE))
+                for row in rows:
+                    if row[0] in self._in_flight:
+                        continue
+                    await self._semaphore.acquire()
+                    self._in_flight.add(row[0])
+                    task = asyncio.create_task(self._deliver(*row))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                    dispatched += 1
+                timeout = None if dispatched else await self._next_due_delay()
+            except Exception as e:
+                logger.error(f"Ошибка в очереди уведомлений: {e}")
+                timeout = 5
+            
+            if not dispatched:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _next_due_delay(self):
+        # Строки, которые уже пора отправлять, либо выбраны в _run, либо уже в отправке
+        # (в том числе ждут интервала чата в _wait_for_chat). Об их завершении, как и о
+        # новых сообщениях, сообщает _wakeup, поэтому по таймеру ждем только отложенные строки
+        now = time.time()
+        row = await db.fetchone(SQL_OUTBOX_NEXT_DUE, (now,))
+        return None if row[0] is None else min(row[0] - now, 30)
+
+    async def _flush_delivered(self):
+        if not self._delivered:
+            return
+        delivered, self._delivered = self._delivered, []
+        await db.transaction(lambda conn: conn.executemany(
+            'DELETE FROM outbox WHERE id = ?', [(outbox_id,) for outbox_id in delivered]
+        ))
+        self._in_flight.difference_update(delivered)
+
+    async def _wait_for_chat(self, chat_id):
+        interval = BROADCAST_GROUP_CHAT_INTERVAL if chat_id < 0 else BROADCAST_PRIVATE_CHAT_INTERVAL
+        now = time.monotonic()
+        if len(self._chat_next_send) > 10000:
+            self._chat_next_send = {k: v for k, v in self._chat_next_send.items() if v > now}
+        ready_at = max(now, self._chat_next_send.get(chat_id, 0))
+        self._chat_next_send[chat_id] = ready_at + interval
+        if ready_at > now:
+            await asyncio.sleep(ready_at - now)
+
+    async def _deliver(self, outbox_id, chat_id, text, parse_mode, attempts):
+        delivered = False
+        try:
+            await self._wait_for_chat(chat_id)
+            await self._bucket.acquire()
+            try:
+                await self._bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+                delivered = True
+            except RetryAfter as e:
+                # Telegram просит подождать - приостанавливаем всю рассылку
+                delay = retry_after_seconds(e)
+                self._bucket.pause(delay)
+                await db.execute('UPDATE outbox SET not_before = ? WHERE id = ?', (time.time() + delay, outbox_id))
+            except (Forbidden, BadRequest) as e:
+                parts = text.split(NOTIFICATION_SEPARATOR)
+                if isinstance(e, BadRequest) and len(parts) > 1:
+                    # Сводка из нескольких уведомлений: одно битое не должно утянуть за собой остальные
+                    logger.warning(f"Сводка {outbox_id} отклонена ({e}), уведомления уйдут по одному")
+                    
+                    def split(conn):
+                        conn.execute('DELETE FROM outbox WHERE id = ?', (outbox_id,))
+                        self.enqueue_in(conn, [(chat_id, part, parse_mode) for part in parts])
+                    
+                    await db.transaction(split)
+                else:
+                    # Пользователь заблокировал бота или чат не существует - повтор не поможет
+                    logger.error(f"Не удалось отправить уведомление пользователю {chat_id}: {e}")
+                    await db.execute('DELETE FROM outbox WHERE id = ?', (outbox_id,))
+            except Exception as e:
+                attempts += 1
+                if attempts >= BROADCAST_MAX_ATTEMPTS:
+                    logger.error(f"Не удалось отправить уведомление пользователю {chat_id} после {attempts} попыток: {e}")
+                    await db.execute('DELETE FROM outbox WHERE id = ?', (outbox_id,))
+                else:
+                    await db.execute(
+                        'UPDATE outbox SET attempts = ?, not_before = ? WHERE id = ?',
+                        (attempts, time.time() + 2 ** attempts, outbox_id)
+                    )
+        except Exception as e:
+            logger.error(f"Ошибка при отправке уведомления {outbox_id}: {e}")
+        finally:
+            if delivered:
+                # Удаляются пачкой в _flush_delivered, до этого не берутся повторно
+                self._delivered.append(outbox_id)
+            else:
+                self._in_flight.discard(outbox_id)
+            self._semaphore.release()
+            self._wakeup.set()
+
+broadcaster = Broadcaster()
+
+# Уведомления для админского чата
+NOTIFICATION_KINDS = {
+    'new_app': '🆕 Новых заявок',
+    'user_delete': '🗑 Удалено пользователями',
+    'admin_delete': '🗑 Удалено администраторами',
+    'settings': '⚙️ Изменений настроек',
+}
+MESSAGE_MAX_LENGTH = 4096
+# Разделитель уведомлений в сводке: по нему broadcaster делит сводку, если Telegram ее отклонил
+NOTIFICATION_SEPARATOR = '\n\n➖➖➖\n\n'
+
+class AdminNotifier:
+    """Копит уведомления для админского чата и передает их в broadcaster, не задерживая ответ пользователю.
+    
+    Первое уведомление после затишья уходит сразу, следующие в течение окна
+    собираются в одну сводку. Частоту отправки в чат ограничивает broadcaster.
+    """
+
+    def __init__(self, chat_id=NOTIFICATION_CHAT_ID, window=NOTIFICATION_DIGEST_WINDOW):
+        self.chat_id = chat_id
+        self.window = window
+        self._pending = []
+        self._pending_since = None
+        self._last_flush = None
+        self._timer = None
+        self._tasks = set()
+
+    def notify(self, kind, text):
+        """Ставит уведомление (HTML) в очередь и сразу возвращается."""
+        if not self._pending:
+            self._pending_since = time.monotonic()
+        self._pending.append((kind, text))
+        if self._timer is None:
+            delay = 0 if self._last_flush is None else max(self._last_flush + self.window - time.monotonic(), 0)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._flush)
+
+    def _flush(self):
+        self._timer = None
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        self._last_flush = time.monotonic()
+        messages = self._compose(pending, self._last_flush - self._pending_since)
+        task = asyncio.create_task(self._enqueue(messages))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _enqueue(self, messages):
+        try:
+            await broadcaster.enqueue([(self.chat_id, text, 'HTML') for text in messages])
+        except Exception as e:
+            logger.error(f"Ошибка при отправке уведомления в админский чат: {e}")
+
+    @staticmethod
+    def _compose(pending, elapsed):
+        if len(pending) == 1:
+            return [pending[0][1]]
+        counts = {}
+        for kind, _ in pending:
+            counts[kind] = counts.get(kind, 0) + 1
+        header = f"📬 <b>Сводка за последние {max(elapsed, 1):.0f} с</b>\n" + '\n'.join(
+            f"{NOTIFICATION_KINDS.get(kind, kind)}: {count}" for kind, count in counts.items()
+        )
+        # Длинная сводка делится на несколько сообщений по границам уведомлений, чтобы не разорвать теги
+        messages, current = [], header
+        for _, text in pending:
+            if len(current) + len(text) + len(NOTIFICATION_SEPARATOR) > MESSAGE_MAX_LENGTH:
+                messages.append(current)
+                current = text
+            else:
+                current += NOTIFICATION_SEPARATOR + text
+        messages.append(current)
+        return messages
+
+    async def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._flush()
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+admin_notifier = AdminNotifier()
+
+class TeammateMatcher:
+    """Подбирает тиммейтов для новой заявки по индексу активных заявок и рассылает
+    лучшие совпадения обеим сторонам через broadcaster, не задерживая ответ пользователю.
+
+    Кандидаты берутся из active_apps.match_candidates, поэтому работа на одну заявку
+    ограничена размером соседних корзин, а не числом активных заявок.
+    """
+
+    def __init__(self, top=MATCH_TOP_N, min_score=MATCH_MIN_SCORE, cooldown=MATCH_NOTIFY_COOLDOWN):
+        self.top = top
+        self.min_score = min_score
+        self.cooldown = cooldown
+        # user_id -> monotonic-время последнего уведомления о новом тиммейте
+        self._notified_at = {}
+        self._tasks = set()
+
+    def find(self, row):
+        """Лучшие совпадения для заявки row: [(оценка, строка SQL_ACTIVE_APPS)], по одной заявке на пользователя."""
+        best = {}
+        scorer = match_scorer(row)
+        for other in active_apps.match_candidates(row):
+            if other[2] == row[2]:
+                continue
+            score = scorer(other)
+            if score >= self.min_score and score > best.get(other[2], (0,))[0]:
+                best[other[2]] = (score, other)
+        return heapq.nlargest(self.top, best.values(), key=lambda match: match[0])
+
+    def notify(self, row):
+        """Запускает подбор для только что сохраненной заявки row и сразу возвращается."""
+        task = asyncio.create_task(self._notify(row))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _notify(self, row):
+        try:
+            matches = self.find(row)
+            if not matches:
+                return
+            messages = [(row[2], self._compose_for_applicant(row, matches), 'HTML')]
+            now = time.monotonic()
+            for score, other in matches:
+                if now - self._notified_at.get(other[2], -self.cooldown) >= self.cooldown:
+                    self._notified_at[other[2]] = now
+                    messages.append((other[2], self._compose_for_candidate(row, other, score), 'HTML'))
+            if len(self._notified_at) > 10000:
+                self._notified_at = {
+                    user_id: sent for user_id, sent in self._notified_at.items() if now - sent < self.cooldown
+                }
+            await broadcaster.enqueue(messages)
+            metrics.increment('bot_match_notifications_total', len(messages))
+        except Exception as e:
+            logger.error(f"Ошибка при подборе тиммейтов для заявки {row[0]}: {e}")
+
+    @staticmethod
+    def _compose_for_applicant(row, matches):
+        # Поля заявок экранирует format_listing_entry; совпадения разделены как уведомления в сводке,
+        # чтобы broadcaster разослал их по одному, если Telegram отклонит сообщение целиком
+        parts = [f"🤝 <b>Подходящие тиммейты для вашей заявки на {TEAM_TYPES.get(row[4], row[4])}</b>"]
+        for i, (score, other) in enumerate(matches, 1):
+            parts.append(
+                f"Совпадение {score:.0%}\n"
+                + format_listing_entry(f"{i}.", 'teammate', ActiveApplicationIndex._listing_row(other)).rstrip()
+            )
+        return NOTIFICATION_SEPARATOR.join(parts)
+
+    @staticmethod
+    def _compose_for_candidate(row, other, score):
+        return (
+            f"🤝 <b>Новый тиммейт для вашей заявки на {TEAM_TYPES.get(other[4], other[4])}</b> "
+            f"(совпадение {score:.0%})\n\n"
+            + format_listing_entry("🆕", 'teammate', ActiveApplicationIndex._listing_row(row))
+        ).rstrip()
+
+    async def stop(self):
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+teammate_matcher = TeammateMatcher()
+
+SUBSCRIBED_STATUSES = ('member', 'administrator', 'creator')
+
+def channel_key(username):
+    return username.lstrip('@').lower()
+
+REQUIRED_CHANNELS = (channel_key(CHANNEL_RUSTRIC), channel_key(CHANNEL_DENZI))
+
+# Локальное состояние подписок на обязательные каналы
+class SubscriptionStore:
+    def __init__(self):
+        # user_id -> {канал: (подписан ли, время обновления)}
+        self._members = {}
+
+    def load(self):
+        rows = db.run_sync(lambda conn: conn.execute(
+            'SELECT channel, user_id, is_member, updated_at FROM channel_subscriptions'
+        ).fetchall())
+        for channel, user_id, is_member, updated_at in rows:
+            self._members.setdefault(user_id, {})[channel] = (bool(is_member), updated_at)
+        logger.info(f"Загружено подписок: {len(rows)}")
+
+    def knows(self, user_id):
+        return user_id in self._members
+
+    def is_subscribed(self, user_id):
+        """True/False по локальным данным или None, если нужно спросить Telegram."""
+        records = self._members.get(user_id, {})
+        now = time.time()
+        for channel in REQUIRED_CHANNELS:
+            record = records.get(channel)
+            if record is None:
+                return None
+            is_member, updated_at = record
+            if not is_member:
+                if updated_at + SUBSCRIPTION_NEGATIVE_CACHE_TTL < now:
+                    return None
+                return False
+            if not SUBSCRIPTIONS_TRACKED_BY_EVENTS and updated_at + SUBSCRIPTION_CACHE_TTL < now:
+                return None
+        return True
+
+    async def update(self, user_id, memberships):
+        """Запоминает {канал: подписан ли} для пользователя."""
+        now = int(time.time())
+        records = self._members.setdefault(user_id, {})
+        for channel, is_member in memberships.items():
+            records[channel] = (is_member, now)
+        await db.transaction(lambda conn: conn.executemany(
+            'INSERT OR REPLACE INTO channel_subscriptions (channel, user_id, is_member, updated_at) VALUES (?, ?, ?, ?)',
+            [(channel, user_id, int(is_member), now) for channel, is_member in memberships.items()]
+        ))
 
-# Утилиты
-def create_button(text, callback_data):
-    return InlineKeyboardButton(text, callback_data=callback_data)
+subscription_store = SubscriptionStore()
+subscription_store.load()
 
-def save_user(user_id, username):
-    # Сохранение в базу данных
-    conn = sqlite3.connect('rust_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT 1 FROM users WHERE user_id = ?', (user_id,))
-    if not cursor.fetchone():
-        cursor.execute(
-            'INSERT INTO users (user_id, username, registration_date) VALUES (?, ?, ?)',
-            (user_id, username, datetime.now().strftime("%d.%m.%Y %H:%M"))
-        )
-    conn.commit()
-    conn.close()
-    
-    # Сохранение в CSV файл
-    user_exists = False
-    with open(USERS_FILE, mode='r', newline='', encoding='utf-8') as file:
-        reader = csv.reader(file)
-        for row in reader:
-            if row and row[0] == str(user_id):
-                user_exists = True
-                break
-    
-    if not user_exists:
-        with open(USERS_FILE, mode='a', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            writer.writerow([user_id, username, datetime.now().strftime("%d.%m.%Y %H:%M")])
+async def fetch_subscriptions(bot, user_id):
+    members = await asyncio.gather(*(
+        bot.get_chat_member(f'@{channel}', user_id) for channel in REQUIRED_CHANNELS
+    ))
+    return {
+        channel: member.status in SUBSCRIBED_STATUSES
+        for channel, member in zip(REQUIRED_CHANNELS, members)
+    }
 
 async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     user = update.effective_user
+    is_subscribed = subscription_store.is_subscribed(user.id)
+    if is_subscribed is not None:
+        return is_subscribed
+    
+    # Пользователя еще не видели или запись устарела - спрашиваем Telegram и запоминаем ответ
     try:
-        member_rustric = await context.bot.get_chat_member(CHANNEL_RUSTRIC, user.id)
-        member_denzi = await context.bot.get_chat_member(CHANNEL_DENZI, user.id)
-        return (member_rustric.status in ['member', 'administrator', 'creator'] and 
-                member_denzi.status in ['member', 'administrator', 'creator'])
+        memberships = await fetch_subscriptions(context.bot, user.id)
     except Exception as e:
         logger.error(f"Ошибка при проверке подписки: {e}")
         return False
-
-async def delete_old_applications(context: CallbackContext):
-    conn = sqlite3.connect('rust_bot.db')
-    cursor = conn.cursor()
-    
-    days_ago = (datetime.now() - timedelta(days=AUTO_DELETE_DAYS)).strftime("%d.%m.%Y %H:%M")
     
-    cursor.execute('''
-    SELECT id, user_id, app_type FROM applications 
-    WHERE date < ? AND is_active = 1
-    ''', (days_ago,))
+    await subscription_store.update(user.id, memberships)
+    return all(memberships.values())
+
+async def handle_channel_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обновляет локальную подписку при вступлении в канал или выходе из него.
     
-    old_apps = cursor.fetchall()
+    Telegram присылает такие обновления, только если бот - администратор канала.
+    """
+    chat_member = update.chat_member
+    if not chat_member or not chat_member.chat.username:
+        return
+    channel = channel_key(chat_member.chat.username)
+    if channel in REQUIRED_CHANNELS:
+        await subscription_store.update(
+            chat_member.new_chat_member.user.id,
+            {channel: chat_member.new_chat_member.status in SUBSCRIBED_STATUSES}
+        )
+
+async def backfill_subscriptions(context: CallbackContext):
+    """Фоновая сверка: проверяет подписку известных пользователей, о которых нет записей."""
+    bucket = TokenBucket(SUBSCRIPTION_BACKFILL_RATE, 1)
+    checked = 0
+    for user_id in list(user_registry.known_ids):
+        if subscription_store.knows(user_id):
+            continue
+        await bucket.acquire()
+        try:
+            memberships = await fetch_subscriptions(context.bot, user_id)
+        except RetryAfter as e:
+            await asyncio.sleep(retry_after_seconds(e))
+            continue
+        except Exception as e:
+            logger.error(f"Ошибка при сверке подписки пользователя {user_id}: {e}")
+            continue
+        await subscription_store.update(user_id, memberships)
+        checked += 1
     
-    for app_id, user_id, app_type in old_apps:
-        cursor.execute('UPDATE applications SET is_active = 0 WHERE id = ?', (app_id,))
+    if checked:
+        logger.info(f"Сверка подписок: проверено {checked} пользователей")
+
+# Хранение состояния диалогов в той же базе
+class SQLitePersistence(BasePersistence):
+    """Сохраняет состояния ConversationHandler и user_data в SQLite.
+    
+    Application сообщает только об измененных записях; они копятся в памяти
+    и записываются одной транзакцией. Записи, которые не изменились с прошлой
+    записи, пропускаются. chat_data, bot_data и callback_data бот не использует.
+    """
+
+    def __init__(self, update_interval=PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        # Значения, которые будут в базе после записи очереди, чтобы не писать одно и то же повторно
+        self._saved_user_data = {}
+        self._saved_states = {}
+        self._pending_user_data = {}
+        self._pending_states = {}
+        self._flush_task = None
+
+    async def get_user_data(self):
+        rows = await db.fetchall('SELECT user_id, data FROM persisted_user_data')
+        user_data = {}
+        for user_id, data in rows:
+            self._saved_user_data[user_id] = data
+            user_data[user_id] = json.loads(data)
+        logger.info(f"Восстановлено user_data: {len(user_data)}")
+        return user_data
+
+    async def get_conversations(self, name):
+        rows = await db.fetchall(
+            'SELECT conversation_key, state FROM conversation_states WHERE name = ?', (name,)
+        )
+        conversations = {}
+        for key, state in rows:
+            self._saved_states[(name, key)] = state
+            conversations[tuple(json.loads(key))] = state
+        logger.info(f"Восстановлено диалогов {name}: {len(conversations)}")
+        return conversations
+
+    async def update_user_data(self, user_id, data):
+        serialized = json.dumps(data, ensure_ascii=False, sort_keys=True)
+        if self._saved_user_data.get(user_id) == serialized:
+            return
+        self._saved_user_data[user_id] = serialized
+        self._pending_user_data[user_id] = serialized
+        self._schedule_flush()
+
+    async def update_conversation(self, name, key, new_state):
+        state_key = (name, json.dumps(key))
+        if self._saved_states.get(state_key) == new_state:
+            return
+        if new_state is None:
+            self._saved_states.pop(state_key, None)
+        else:
+            self._saved_states[state_key] = new_state
+        self._pending_states[state_key] = new_state
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._saved_user_data.pop(user_id, None)
+        self._pending_user_data[user_id] = None
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        # Application вызывает update_* для всех измененных записей разом,
+        # поэтому запись откладывается до следующей итерации event loop
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self):
+        await asyncio.sleep(0)
+        user_data, self._pending_user_data = self._pending_user_data, {}
+        states, self._pending_states = self._pending_states, {}
+        if not user_data and not states:
+            return
+        
+        def write(conn):
+            conn.executemany(
+                'INSERT OR REPLACE INTO persisted_user_data (user_id, data) VALUES (?, ?)',
+                [(user_id, data) for user_id, data in user_data.items() if data is not None]
+            )
+            conn.executemany(
+                'DELETE FROM persisted_user_data WHERE user_id = ?',
+                [(user_id,) for user_id, data in user_data.items() if data is None]
+            )
+            conn.executemany(
+                'INSERT OR REPLACE INTO conversation_states (name, conversation_key, state) VALUES (?, ?, ?)',
+                [(name, key, state) for (name, key), state in states.items() if state is not None]
+            )
+            conn.executemany(
+                'DELETE FROM conversation_states WHERE name = ? AND conversation_key = ?',
+                [state_key for state_key, state in states.items() if state is None]
+            )
         
         try:
+            await db.transaction(write)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении состояния диалогов: {e}")
+            # Возвращаем в очередь, если за это время не пришли более свежие значения
+            for user_id, data in user_data.items():
+                self._pending_user_data.setdefault(user_id, data)
+            for state_key, state in states.items():
+                self._pending_states.setdefault(state_key, state)
+
+    async def flush(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write_pending()
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+async def delete_old_applications(context: CallbackContext):
+    days_ago = int((datetime.now() - timedelta(days=AUTO_DELETE_DAYS)).timestamp())
+    
+    def expire(conn):
+        old_apps = conn.execute(SQL_EXPIRE_APPS, (days_ago,)).fetchall()
+        
+        # Уведомления попадают в очередь в той же транзакции, поэтому не теряются при перезапуске
+        messages = []
+        for app_id, user_id, app_type, team_type in old_apps:
             message = f"🕒 Ваша заявка на поиск тиммейта была автоматически удалена из системы по истечении {AUTO_DELETE_DAYS} дней."
             if app_type == 'clan':
                 message = f"🕒 Ваша заявка на поиск клана была автоматически удалена из системы по истечении {AUTO_DELETE_DAYS} дней."
-            
-            await context.bot.send_message(chat_id=user_id, text=message)
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомление пользователю {user_id}: {e}")
+            messages.append((user_id, message, None))
+        Broadcaster.enqueue_in(conn, messages)
+        return old_apps
+    
+    old_apps = await db.transaction(expire)
+    broadcaster.wake()
+    
+    for app_id, user_id, app_type, team_type in old_apps:
+        active_apps.remove(app_id)
+        invalidate_category(app_type, team_type)
     
-    conn.commit()
-    conn.close()
     logger.info(f"Автоматически удалено {len(old_apps)} заявок старше {AUTO_DELETE_DAYS} дней")
 
 async def send_welcome_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -196,16 +1990,10 @@ async def send_welcome_message(update: Update, context: ContextTypes.DEFAULT_TYP
         "Для начала работы подпишитесь на наши каналы и нажмите /start"
     )
     
-    keyboard = [
-        [InlineKeyboardButton("Rustric", url=f"https://t.me/{CHANNEL_RUSTRIC[1:]}")],
-        [InlineKeyboardButton("Дэнзи", url=f"https://t.me/{CHANNEL_DENZI[1:]}")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
         text=welcome_text,
-        reply_markup=reply_markup
+        reply_markup=WELCOME_KEYBOARD
     )
 
 async def safe_edit_message(query, text, reply_markup=None):
@@ -221,6 +2009,7 @@ async def safe_edit_message(query, text, reply_markup=None):
         )
     except Exception as e:
         if "Message is not modified" in str(e):
+            metrics.increment('bot_message_not_modified_total')
             logger.debug("Сообщение не изменено (содержимое идентично)")
         elif "Message to edit not found" in str(e):
             logger.debug("Сообщение для редактирования не найдено, отправляем новое")
@@ -230,8 +2019,10 @@ async def safe_edit_message(query, text, reply_markup=None):
                     reply_markup=reply_markup
                 )
             except Exception as e:
+                metrics.increment('bot_edit_message_errors_total')
                 logger.error(f"Ошибка при отправке нового сообщения: {e}")
         else:
+            metrics.increment('bot_edit_message_errors_total')
             logger.error(f"Ошибка при редактировании сообщения: {e}")
 
 # Главное меню
@@ -254,18 +2045,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         "🏠 <b>Главное меню</b>:"
     )
     
-    keyboard = [
-        [create_button("🔍 Найти Тиммейта", 'find_teammate')],
-        [create_button("🏰 Клан", 'find_clan')],
-        [create_button("❌ Удалиться из поиска", 'remove_from_search')],
-        [create_button("📚 Гайд по боту", 'guide')]
-    ]
-    
-    # Добавляем кнопку админа только если пользователь админ
-    if str(user.id) in ADMIN_IDS.split(','):
-        keyboard.append([create_button("👑 Админу", 'admin_panel')])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Кнопка админ-панели есть только в варианте меню для админов
+    reply_markup = ADMIN_MAIN_MENU_KEYBOARD if is_admin(user.id) else MAIN_MENU_KEYBOARD
     
     try:
         if update.callback_query:
@@ -293,6 +2074,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             )
         return CHOOSING
     except Exception as e:
+        count_handler_error('start')
         logger.error(f"Ошибка в start: {e}")
         return ConversationHandler.END
 
@@ -301,20 +2083,10 @@ async def find_teammate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     query = update.callback_query
     await query.answer()
     
-    keyboard = [
-        [create_button("👥 Duo", 'duo')],
-        [create_button("👥👥 Trio", 'trio')],
-        [create_button("👥👥👥 Quad", 'quad')],
-        [create_button("👥👥👥+ Quad+", 'quad_plus')],
-        [create_button("🔙 Назад в главное меню", 'back_to_main')]
-    ]
-    
-    message_text = '🎮 Выберите тип поиска:'
-    
     await safe_edit_message(
         query,
-        message_text,
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        '🎮 Выберите тип поиска:',
+        reply_markup=TEAMMATE_MENU_KEYBOARD
     )
     return CHOOSING
 
@@ -324,113 +2096,25 @@ async def find_clan(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await query.answer()
     context.user_data["app_type"] = "clan"
     
-    keyboard = [
-        [create_button("📝 Подать Заявку", 'apply_clan')],
-        [create_button("📋 Список Заявок", 'list_clan')],
-        [create_button("✏️ Мои заявки", 'my_apps_clan')],
-        [create_button("🔙 Назад в главное меню", 'back_to_main')]
-    ]
-    
-    message_text = "🏰 Выберите действие для поиска клана:"
-    
-    await safe_edit_message(
-        query,
-        message_text,
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
-    return CHOOSING
-
-# Обработчики для типов команд
-async def duo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
-    context.user_data['team_type'] = 'duo'
-    context.user_data['app_type'] = 'teammate'
-    
-    keyboard = [
-        [create_button("📝 Подать Заявку", 'apply_duo')],
-        [create_button("📋 Список Заявок", 'list_duo')],
-        [create_button("✏️ Мои заявки", 'my_apps_duo')],
-        [create_button("🔙 Назад", 'back_to_teammate')],
-        [create_button("🏠 Главное меню", 'back_to_main')]
-    ]
-    
-    message_text = "👥 Выберите действие для Duo:"
-    
-    await safe_edit_message(
-        query,
-        message_text,
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
-    return CHOOSING
-
-async def trio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
-    context.user_data['team_type'] = 'trio'
-    context.user_data['app_type'] = 'teammate'
-    
-    keyboard = [
-        [create_button("📝 Подать Заявку", 'apply_trio')],
-        [create_button("📋 Список Заявок", 'list_trio')],
-        [create_button("✏️ Мои заявки", 'my_apps_trio')],
-        [create_button("🔙 Назад", 'back_to_teammate')],
-        [create_button("🏠 Главное меню", 'back_to_main')]
-    ]
-    
-    message_text = "👥👥 Выберите действие для Trio:"
-    
     await safe_edit_message(
         query,
-        message_text,
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        "🏰 Выберите действие для поиска клана:",
+        reply_markup=CLAN_MENU_KEYBOARD
     )
     return CHOOSING
 
-async def quad(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+# Меню типа команды: одна реализация для duo, trio, quad и quad_plus,
+# вызывается и по кнопке типа, и по кнопке "Назад" вида back_to_<тип>
+async def team_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    context.user_data['team_type'] = 'quad'
-    context.user_data['app_type'] = 'teammate'
-    
-    keyboard = [
-        [create_button("📝 Подать Заявку", 'apply_quad')],
-        [create_button("📋 Список Заявок", 'list_quad')],
-        [create_button("✏️ Мои заявки", 'my_apps_quad')],
-        [create_button("🔙 Назад", 'back_to_teammate')],
-        [create_button("🏠 Главное меню", 'back_to_main')]
-    ]
     
-    message_text = "👥👥👥 Выберите действие для Quad:"
-    
-    await safe_edit_message(
-        query,
-        message_text,
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
-    return CHOOSING
-
-async def quad_plus(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
-    context.user_data['team_type'] = 'quad_plus'
+    team_type = query.data.removeprefix('back_to_')
+    context.user_data['team_type'] = team_type
     context.user_data['app_type'] = 'teammate'
     
-    keyboard = [
-        [create_button("📝 Подать Заявку", 'apply_quad_plus')],
-        [create_button("📋 Список Заявок", 'list_quad_plus')],
-        [create_button("✏️ Мои заявки", 'my_apps_quad_plus')],
-        [create_button("🔙 Назад", 'back_to_teammate')],
-        [create_button("🏠 Главное меню", 'back_to_main')]
-    ]
-    
-    message_text = "👥👥👥+ Выберите действие для Quad+:"
-    
-    await safe_edit_message(
-        query,
-        message_text,
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+    message_text, reply_markup = TEAM_MENUS[team_type]
+    await safe_edit_message(query, message_text, reply_markup=reply_markup)
     return CHOOSING
 
 # Обработка заявки
@@ -498,79 +2182,82 @@ async def save_application(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         app_type = context.user_data.get('app_type', 'teammate')
         user = update.message.from_user
         
+        # Заявка показывается в списках вместе с данными пользователя,
+        # поэтому нового пользователя записываем в базу сразу
         save_user(user.id, user.username or user.first_name)
-        
-        conn = sqlite3.connect('rust_bot.db')
-        cursor = conn.cursor()
+        await user_registry.flush()
         
         if app_type == 'teammate':
-            cursor.execute('''
-            INSERT INTO applications 
-            (user_id, app_type, team_type, age, hours, role, online, discord, date, is_active) 
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
-            ''', (
-                user.id, app_type, team_type, user_data[0].strip(), 
-                user_data[1].strip(), user_data[2].strip(), 
-                user_data[3].strip(), user_data[4].strip(), 
-                datetime.now().strftime("%d.%m.%Y %H:%M")
-            ))
+            def insert(conn):
+                cursor = conn.execute('''
+                INSERT INTO applications 
+                (user_id, app_type, team_type, age, hours, role, online, discord, date, created_at, is_active) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+                ''', (
+                    user.id, app_type, team_type, user_data[0].strip(), 
+                    user_data[1].strip(), user_data[2].strip(), 
+                    user_data[3].strip(), user_data[4].strip(), 
+                    datetime.now().strftime("%d.%m.%Y %H:%M"), int(time.time())
+                ))
+                store_parsed_application(conn, cursor.lastrowid, app_type, user_data)
+                # Строка для индекса активных заявок читается в той же транзакции
+                return conn.execute(SQL_ACTIVE_APP, (cursor.lastrowid,)).fetchone()
             
-            # Получаем ID только что созданной заявки
-            app_id = cursor.lastrowid
+            row = await db.transaction(insert)
+            app_id = row[0]
+            active_apps.apply(app_id, row)
+            invalidate_category(app_type, team_type)
+            # Подходящие заявки приходят обеим сторонам сами, без повторных просмотров списка
+            teammate_matcher.notify(row)
             
             # Формируем сообщение для админского чата
             notification_text = (
                 "🆕 <b>Новая заявка на тиммейта</b>\n\n"
-                f"👤 Пользователь: @{user.username or user.first_name} (ID: {user.id})\n"
+                f"👤 Пользователь: @{html.escape(user.username or user.first_name)} (ID: {user.id})\n"
                 f"📌 Тип: {TEAM_TYPES.get(team_type, team_type)}\n"
                 f"🆔 ID заявки: {app_id}\n\n"
-                f"🎂 Возраст: {user_data[0].strip()}\n"
-                f"⏱ Часов в Rust: {user_data[1].strip()}\n"
-                f"🎮 Роль: {user_data[2].strip()}\n"
-                f"⏳ Онлайн в день: {user_data[3].strip()}\n"
-                f"📞 Discord: {user_data[4].strip()}\n"
+                f"🎂 Возраст: {html.escape(user_data[0].strip())}\n"
+                f"⏱ Часов в Rust: {html.escape(user_data[1].strip())}\n"
+                f"🎮 Роль: {html.escape(user_data[2].strip())}\n"
+                f"⏳ Онлайн в день: {html.escape(user_data[3].strip())}\n"
+                f"📞 Discord: {html.escape(user_data[4].strip())}\n"
                 f"📅 Дата: {datetime.now().strftime('%d.%m.%Y %H:%M')}"
             )
         else:
-            cursor.execute('''
-            INSERT INTO applications 
-            (user_id, app_type, clan_name, leader_name, required, members_count, discord, date, is_active) 
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)
-            ''', (
-                user.id, app_type, user_data[0].strip(), 
-                user_data[1].strip(), user_data[2].strip(),
-                user_data[3].strip(), user_data[4].strip(),
-                datetime.now().strftime("%d.%m.%Y %H:%M")
-            ))
+            def insert(conn):
+                cursor = conn.execute('''
+                INSERT INTO applications 
+                (user_id, app_type, clan_name, leader_name, required, members_count, discord, date, created_at, is_active) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+                ''', (
+                    user.id, app_type, user_data[0].strip(), 
+                    user_data[1].strip(), user_data[2].strip(),
+                    user_data[3].strip(), user_data[4].strip(),
+                    datetime.now().strftime("%d.%m.%Y %H:%M"), int(time.time())
+                ))
+                store_parsed_application(conn, cursor.lastrowid, app_type, user_data)
+                return conn.execute(SQL_ACTIVE_APP, (cursor.lastrowid,)).fetchone()
             
-            # Получаем ID только что созданной заявки
-            app_id = cursor.lastrowid
+            row = await db.transaction(insert)
+            app_id = row[0]
+            active_apps.apply(app_id, row)
+            invalidate_category(app_type, team_type)
             
             # Формируем сообщение для админского чата
             notification_text = (
                 "🆕 <b>Новая заявка на клан</b>\n\n"
-                f"👤 Пользователь: @{user.username or user.first_name} (ID: {user.id})\n"
+                f"👤 Пользователь: @{html.escape(user.username or user.first_name)} (ID: {user.id})\n"
                 f"🆔 ID заявки: {app_id}\n\n"
-                f"🏰 Название: {user_data[0].strip()}\n"
-                f"👑 Лидер: {user_data[1].strip()}\n"
-                f"🔍 Требуются: {user_data[2].strip()}\n"
-                f"👥 Количество участников: {user_data[3].strip()}\n"
-                f"📞 Discord: {user_data[4].strip()}\n"
+                f"🏰 Название: {html.escape(user_data[0].strip())}\n"
+                f"👑 Лидер: {html.escape(user_data[1].strip())}\n"
+                f"🔍 Требуются: {html.escape(user_data[2].strip())}\n"
+                f"👥 Количество участников: {html.escape(user_data[3].strip())}\n"
+                f"📞 Discord: {html.escape(user_data[4].strip())}\n"
                 f"📅 Дата: {datetime.now().strftime('%d.%m.%Y %H:%M')}"
             )
         
-        conn.commit()
-        conn.close()
-        
         # Отправляем уведомление в админский чат
-        try:
-            await context.bot.send_message(
-                chat_id=NOTIFICATION_CHAT_ID,
-                text=notification_text,
-                parse_mode='HTML'
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при отправке уведомления в админский чат: {e}")
+        admin_notifier.notify('new_app', notification_text)
         
         if app_type == 'teammate':
             response = (
@@ -602,132 +2289,389 @@ async def save_application(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return await start(update, context)
     
     except Exception as e:
+        count_handler_error('save_application')
         logger.error(f"Ошибка при сохранении заявки: {e}")
         await update.message.reply_text("⚠️ Произошла ошибка при сохранении заявки. Попробуйте позже.")
         return await start(update, context)
 
 # Список заявок с пагинацией
-async def list_applications(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+APPS_PER_PAGE = 5
+
+# Сколько готовых страниц хранить на категорию
+RENDERED_PAGES_PER_CATEGORY = 50
+
+def format_listing_entry(title, app_type, app):
+    """Заявка в списке; app - строка списка (id, created_at, username, поля заявки, discord, date).
+    Текст уходит с parse_mode='HTML', поэтому поля пользователя экранируются."""
+    app = [html.escape(str(value)) for value in app]
+    if app_type == 'teammate':
+        return (
+            f"{title} 👤 {app[2]} ({app[8]})\n"
+            f"   🎂 Возраст: {app[3]}\n"
+            f"   ⏱ Часов: {app[4]}\n"
+            f"   🎮 Роль: {app[5]}\n"
+            f"   ⏳ Онлайн: {app[6]}\n"
+            f"   📞 Discord: {app[7]}\n\n"
+        )
+    return (
+        f"{title} 🏰 {app[3]} ({app[8]})\n"
+        f"   👑 Лидер: {app[4]}\n"
+        f"   🔍 Требуются: {app[5]}\n"
+        f"   👥 Участников: {app[6]}\n"
+        f"   📞 Discord: {app[7]}\n\n"
+    )
+
+async def render_applications_page(app_type, team_type, page, direction, cursor, filters=NO_FILTERS):
+    """Загружает и форматирует страницу списка. Возвращает (номер страницы, текст, клавиатура).
+    Без фильтров страница берется из индекса активных заявок, с фильтрами - запросом к базе.
+    Страница кэшируется для всей категории, поэтому у кланов team_type не участвует ни в тексте,
+    ни в кнопках: в кнопках вместо него пустая строка."""
+    team_type = category_key(app_type, team_type)[1]
+    team_arg = team_type or ''
+    selected = selected_list_filters(app_type, filters)
+    code = filter_code(filters)
+    if selected:
+        queries, count_sql, params = build_filtered_list_queries(app_type, team_type, filters)
+        fetch = sql_page_fetcher(queries, params)
+    else:
+        fetch = active_apps.page_fetcher(app_type, team_type)
+    apps, page, has_newer, has_older = await fetch_keyset_page(fetch, APPS_PER_PAGE, page, direction, cursor)
+    
+    if not apps:
+        keyboard = [
+            [create_button("🔙 Назад", 'back_from_clan_list' if app_type == 'clan' else f'back_to_{team_type}')],
+            [create_button("🏠 Главное меню", 'back_to_main')]
+        ]
+        if selected:
+            keyboard[:0] = [
+                [create_button("🔎 Изменить фильтры", callback_data('list_filters', team_arg, code))],
+                [create_button("♻️ Сбросить фильтры", callback_data('list_filtered', team_arg, filter_code(NO_FILTERS)))],
+            ]
+            return page, "ℹ️ Нет заявок, подходящих под выбранные фильтры.", InlineKeyboardMarkup(keyboard)
+        if app_type == 'clan':
+            return page, "ℹ️ Нет заявок кланов.", InlineKeyboardMarkup(keyboard)
+        return page, f"ℹ️ Нет заявок в категории {TEAM_TYPES.get(team_type, team_type)}.", InlineKeyboardMarkup(keyboard)
+    
+    if selected:
+        total_apps = (await db.fetchone(count_sql, params))[0]
+    else:
+        total_apps = active_apps.count(app_type, team_type)
+    total_pages = max((total_apps + APPS_PER_PAGE - 1) // APPS_PER_PAGE, page + 1)
+    start_idx = page * APPS_PER_PAGE
+    
+    if app_type == 'teammate':
+        parts = [f"📋 Список заявок {TEAM_TYPES.get(team_type, team_type)} (Страница {page + 1}/{total_pages}):\n\n"]
+    else:
+        parts = ["📋 Список кланов:\n\n"]
+    for idx, app in enumerate(apps, start_idx + 1):
+        parts.append(format_listing_entry(f"{idx}.", app_type, app))
+    if selected:
+        parts.insert(1, "🔎 Фильтры: " + "; ".join(description for _, _, description in selected) + "\n\n")
+    
+    # В кнопках навигации передаем номер страницы, ключ граничной заявки и код фильтров
+    keyboard = []
+    nav_buttons = []
+    if has_newer:
+        first_id, first_created_at = apps[0][0], apps[0][1]
+        nav_buttons.append(create_button("⬅️ Предыдущая", callback_data('prev_page', team_arg, page, first_created_at, first_id, code)))
+    if has_older:
+        last_id, last_created_at = apps[-1][0], apps[-1][1]
+        nav_buttons.append(create_button("➡️ Следующая", callback_data('next_page', team_arg, page, last_created_at, last_id, code)))
+    if nav_buttons:
+        keyboard.append(nav_buttons)
+    
+    keyboard.append([create_button("🔎 Фильтры", callback_data('list_filters', team_arg, code))])
+    
+    if app_type == 'clan':
+        keyboard.append([create_button("🔙 Назад", 'back_from_clan_list')])
+    else:
+        # Страница общая для всех, поэтому есть ли у зрителя своя заявка, проверяет list_best
+        keyboard[-1].append(create_button("⭐ Лучшие для меня", callback_data('list_best', team_type, 0)))
+        keyboard.append([create_button(f"🔙 Назад к {TEAM_TYPES.get(team_type, team_type)}", f'back_to_{team_type}')])
+    
+    keyboard.append([create_button("🏠 Главное меню", 'back_to_main')])
+    return page, ''.join(parts), InlineKeyboardMarkup(keyboard)
+
+async def list_applications(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                            page=0, direction=None, cursor=None, filters=NO_FILTERS) -> int:
+    """Показывает страницу заявок категории.
+    
+    Страницы листаются по ключу (created_at, id): direction='after' - заявки старее
+    cursor, direction='before' - новее. Без direction показывается первая страница.
+    filters - номера вариантов LIST_FILTERS.
+    Готовая страница берется из rendered_pages, если категория с тех пор не менялась.
+    """
     try:
         query = update.callback_query
         await query.answer()
         
         team_type = context.user_data.get('team_type', 'duo')
         app_type = context.user_data.get('app_type', 'teammate')
-        page = context.user_data.get('page', 0)
-        
-        conn = sqlite3.connect('rust_bot.db')
-        cursor = conn.cursor()
-        
-        if app_type == 'teammate':
-            cursor.execute('''
-            SELECT u.username, a.age, a.hours, a.role, a.online, a.discord, a.date 
-            FROM applications a
-            JOIN users u ON a.user_id = u.user_id
-            WHERE a.team_type = ? AND a.app_type = ? AND a.is_active = 1
-            ORDER BY a.date DESC
-            ''', (team_type, app_type))
-        else:
-            cursor.execute('''
-            SELECT u.username, a.clan_name, a.leader_name, a.required, a.members_count, a.discord, a.date 
-            FROM applications a
-            JOIN users u ON a.user_id = u.user_id
-            WHERE a.app_type = ? AND a.is_active = 1
-            ORDER BY a.date DESC
-            ''', (app_type,))
-        
-        all_apps = cursor.fetchall()
-        conn.close()
-        
-        if not all_apps:
-            keyboard = [
-                [create_button("🔙 Назад", f'back_to_{team_type}')],
-                [create_button("🏠 Главное меню", 'back_to_main')]
-            ]
-            await safe_edit_message(
-                query,
-                f"ℹ️ Нет заявок в категории {TEAM_TYPES.get(team_type, team_type)}.",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-            return CHOOSING
-        
-        # Разбиваем на страницы по 5 заявок
-        apps_per_page = 5
-        total_pages = (len(all_apps) + apps_per_page - 1) // apps_per_page
-        start_idx = page * apps_per_page
-        end_idx = start_idx + apps_per_page
-        filtered_apps = all_apps[start_idx:end_idx]
-        
-        if app_type == 'teammate':
-            applications_text = f"📋 Список заявок {TEAM_TYPES.get(team_type, team_type)} (Страница {page + 1}/{total_pages}):\n\n"
-            for idx, app in enumerate(filtered_apps, start_idx + 1):
-                applications_text += (
-                    f"{idx}. 👤 {app[0]} ({app[6]})\n"
-                    f"   🎂 Возраст: {app[1]}\n"
-                    f"   ⏱ Часов: {app[2]}\n"
-                    f"   🎮 Роль: {app[3]}\n"
-                    f"   ⏳ Онлайн: {app[4]}\n"
-                    f"   📞 Discord: {app[5]}\n\n"
-                )
-        else:
-            applications_text = "📋 Список кланов:\n\n"
-            for idx, clan in enumerate(filtered_apps, start_idx + 1):
-                applications_text += (
-                    f"{idx}. 🏰 {clan[1]} ({clan[6]})\n"
-                    f"   👑 Лидер: {clan[2]}\n"
-                    f"   🔍 Требуются: {clan[3]}\n"
-                    f"   👥 Участников: {clan[4]}\n"
-                    f"   📞 Discord: {clan[5]}\n\n"
-                )
-        
-        keyboard = []
-        if total_pages > 1:
-            nav_buttons = []
-            if page > 0:
-                nav_buttons.append(create_button("⬅️ Предыдущая", f'prev_page_{team_type}'))
-            if page < total_pages - 1:
-                nav_buttons.append(create_button("➡️ Следующая", f'next_page_{team_type}'))
-            if nav_buttons:
-                keyboard.append(nav_buttons)
-        
-        if app_type == 'clan':
-            keyboard.append([create_button("🔙 Назад", 'back_from_clan_list')])
-        else:
-            keyboard.append([create_button(f"🔙 Назад к {TEAM_TYPES.get(team_type, team_type)}", f'back_to_{team_type}')])
         
-        keyboard.append([create_button("🏠 Главное меню", 'back_to_main')])
+        view = (filters, page, direction, cursor)
+        pages = rendered_pages.setdefault(category_key(app_type, team_type), {})
+        rendered = pages.get(view)
+        if rendered is None:
+            rendered = await render_applications_page(app_type, team_type, page, direction, cursor, filters)
+            # Если категорию сбросили во время загрузки, pages уже не в rendered_pages
+            # и устаревшая страница никому не достанется
+            if len(pages) >= RENDERED_PAGES_PER_CATEGORY:
+                pages.pop(next(iter(pages)))
+            pages[view] = rendered
+        page, applications_text, reply_markup = rendered
         
         context.user_data['page'] = page
         
         await safe_edit_message(
             query,
-            text=applications_text,
+            text=applications_text,
+            reply_markup=reply_markup
+        )
+        return CHOOSING
+    
+    except Exception as e:
+        count_handler_error('list_applications')
+        logger.error(f"Ошибка в list_applications: {e}")
+        await safe_edit_message(
+            query,
+            "⚠️ Произошла ошибка при загрузке списка. Попробуйте позже."
+        )
+        return await start(update, context)
+
+def parse_list_page_callback(data):
+    """Разбирает '<действие>:<team_type>:<page>:<created_at>:<id>[:<код фильтров>]'."""
+    team_type, page, created_at, app_id, *code = callback_args(data)
+    filters = parse_filter_code(code[0]) if code else NO_FILTERS
+    return team_type, int(page), (int(created_at), int(app_id)), filters
+
+def remember_list_team_type(context, team_type):
+    # В кнопках кланового списка team_type пустой - выбранная категория тиммейтов не меняется
+    if team_type:
+        context.user_data['team_type'] = team_type
+
+# Обработка переключения страниц
+async def handle_prev_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    try:
+        team_type, page, cursor, filters = parse_list_page_callback(update.callback_query.data)
+    except ValueError:
+        # Кнопка из старого сообщения - показываем первую страницу
+        return await list_applications(update, context)
+    
+    remember_list_team_type(context, team_type)
+    return await list_applications(update, context, page=page, direction='before', cursor=cursor, filters=filters)
+
+async def handle_next_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    try:
+        team_type, page, cursor, filters = parse_list_page_callback(update.callback_query.data)
+    except ValueError:
+        return await list_applications(update, context)
+    
+    remember_list_team_type(context, team_type)
+    return await list_applications(update, context, page=page, direction='after', cursor=cursor, filters=filters)
+
+# Фильтры списка: каждая кнопка переключает свой фильтр на следующий вариант
+async def list_filters(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    
+    try:
+        team_type, code = callback_args(query.data)
+    except ValueError:
+        return await list_applications(update, context)
+    filters = parse_filter_code(code)
+    remember_list_team_type(context, team_type)
+    app_type = context.user_data.get('app_type', 'teammate')
+    
+    keyboard = []
+    for position, ((_, _, options), label) in enumerate(zip(LIST_FILTERS, list_filter_labels(app_type))):
+        if label is None:
+            continue
+        switched = filters[:position] + ((filters[position] + 1) % len(options),) + filters[position + 1:]
+        keyboard.append([create_button(
+            f"{label}: {options[filters[position]][1]}", callback_data('list_filters', team_type, filter_code(switched))
+        )])
+    keyboard.append([create_button("✅ Показать заявки", callback_data('list_filtered', team_type, filter_code(filters)))])
+    keyboard.append([create_button("♻️ Сбросить фильтры", callback_data('list_filters', team_type, filter_code(NO_FILTERS)))])
+    if app_type == 'clan':
+        keyboard.append([create_button("🔙 Назад", 'back_from_clan_list')])
+    else:
+        keyboard.append([create_button(f"🔙 Назад к {TEAM_TYPES.get(team_type, team_type)}", f'back_to_{team_type}')])
+    
+    title = "кланов" if app_type == 'clan' else TEAM_TYPES.get(team_type, team_type)
+    await safe_edit_message(
+        query,
+        text=f"🔎 Фильтры списка {title}\n\nНажмите на фильтр, чтобы сменить его значение, затем «Показать заявки».",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    return CHOOSING
+
+async def list_filtered(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    try:
+        team_type, code = callback_args(update.callback_query.data)
+    except ValueError:
+        return await list_applications(update, context)
+    
+    remember_list_team_type(context, team_type)
+    return await list_applications(update, context, filters=parse_filter_code(code))
+
+# Сортировка "лучшие для меня": заявки категории по близости к собственной заявке пользователя
+async def list_best(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """'list_best:<team_type>:<page>'. Оценки те же, что у подбора тиммейтов (match_scorer);
+    с NumPy считаются по матрице признаков категории, без него - циклом по заявкам."""
+    query = update.callback_query
+    await query.answer()
+    
+    try:
+        team_type, page = callback_args(query.data)
+        page = max(int(page), 0)
+    except ValueError:
+        return await list_applications(update, context)
+    context.user_data['team_type'] = team_type
+    team_name = TEAM_TYPES.get(team_type, team_type)
+    
+    own = active_apps.own_teammate_app(query.from_user.id, team_type)
+    if own is None:
+        keyboard = [
+            [create_button(f"🔙 Назад к {team_name}", f'back_to_{team_type}')],
+            [create_button("🏠 Главное меню", 'back_to_main')]
+        ]
+        await safe_edit_message(
+            query,
+            text=f"ℹ️ Чтобы подобрать заявки под вас, сначала подайте свою заявку в {team_name}.",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
         return CHOOSING
     
-    except Exception as e:
-        logger.error(f"Ошибка в list_applications: {e}")
-        await safe_edit_message(
-            query,
-            "⚠️ Произошла ошибка при загрузке списка. Попробуйте позже."
-        )
-        return await start(update, context)
+    total, ranked = active_apps.ranked(own, page * APPS_PER_PAGE, APPS_PER_PAGE)
+    if not ranked and page:
+        # Страница опустела после удаления заявок - показываем первую
+        page = 0
+        total, ranked = active_apps.ranked(own, 0, APPS_PER_PAGE)
     
-# Обработка переключения страниц
-async def handle_prev_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
+    keyboard = []
+    if ranked:
+        total_pages = (total + APPS_PER_PAGE - 1) // APPS_PER_PAGE
+        parts = [f"⭐ Лучшие для вас заявки {team_name} (Страница {page + 1}/{total_pages}):\n\n"]
+        for idx, (score, app) in enumerate(ranked, page * APPS_PER_PAGE + 1):
+            parts.append(format_listing_entry(f"{idx}. [{score:.0%}]", 'teammate', app))
+        text = ''.join(parts)
+        nav_buttons = []
+        if page > 0:
+            nav_buttons.append(create_button("⬅️ Предыдущая", callback_data('list_best', team_type, page - 1)))
+        if (page + 1) * APPS_PER_PAGE < total:
+            nav_buttons.append(create_button("➡️ Следующая", callback_data('list_best', team_type, page + 1)))
+        if nav_buttons:
+            keyboard.append(nav_buttons)
+    else:
+        text = f"ℹ️ Кроме ваших, заявок в категории {team_name} пока нет."
     
-    context.user_data['page'] -= 1
-    return await list_applications(update, context)
+    keyboard.append([create_button("📋 Обычный порядок", callback_data('list_filtered', team_type, filter_code(NO_FILTERS)))])
+    keyboard.append([create_button(f"🔙 Назад к {team_name}", f'back_to_{team_type}')])
+    keyboard.append([create_button("🏠 Главное меню", 'back_to_main')])
+    await safe_edit_message(query, text=text, reply_markup=InlineKeyboardMarkup(keyboard))
+    return CHOOSING
 
-async def handle_next_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+# Полнотекстовый поиск по ролям, кланам и требованиям
+SEARCH_PER_PAGE = 5
+SEARCH_MAX_QUERY_LENGTH = 100
+SEARCH_MAX_TERMS = 5
+SEARCH_IGNORED_WORDS = frozenset(('or', 'and', 'not', 'near'))
+
+SEARCH_PROMPT_TEXT = (
+    "🔎 Введите, что ищете: роль, название клана, имя лидера или кого требует клан.\n\n"
+    "Например: электрик, строитель рейдер, Rust Legends"
+)
+
+def build_search_query(text):
+    """Запрос FTS5 из слов пользователя: все слова должны найтись, каждое ищется по префиксу основы.
+    Пустая строка - искать нечего."""
+    # Операторы FTS5 из ввода ("строитель OR электрик") не ищутся как обязательные слова
+    words = [
+        word for word in _WORD_RE.findall(text.lower().replace('ё', 'е'))
+        if len(word) > 1 and word not in SEARCH_IGNORED_WORDS
+    ]
+    # Грубое отсечение окончаний: "строитель" находит "строители", "электрики" - "электрик".
+    # Слова в кавычках, чтобы AND/OR/NOT из ввода не стали операторами
+    return ' '.join(f'"{word[:-2] if len(word) >= 6 else word}"*' for word in words[:SEARCH_MAX_TERMS])
+
+async def search_applications(match, page):
+    """Возвращает (количество найденных, строки страницы из индекса активных заявок) по рангу."""
+    (total,), rows = await asyncio.gather(
+        db.fetchone(SQL_SEARCH_COUNT, (match,)),
+        db.fetchall(SQL_SEARCH, (match, SEARCH_PER_PAGE, page * SEARCH_PER_PAGE)),
+    )
+    return total, active_apps.entries([row[0] for row in rows])
+
+async def show_search_results(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0) -> int:
+    if update.callback_query:
+        await update.callback_query.answer()
+    
+    query_text = context.user_data.get('search_query', '')
+    match = build_search_query(query_text)
+    if not match:
+        await reply_or_edit(update, "❌ Введите хотя бы одно слово для поиска.", BACK_TO_MAIN_KEYBOARD)
+        return TYPING_SEARCH
+    
+    total, hits = await search_applications(match, page)
+    if not hits and page:
+        # Страница опустела после удаления заявок - показываем первую
+        page = 0
+        total, hits = await search_applications(match, page)
+    
+    escaped_query = html.escape(query_text)
+    keyboard = []
+    if hits:
+        total_pages = max((total + SEARCH_PER_PAGE - 1) // SEARCH_PER_PAGE, page + 1)
+        parts = [f"🔎 Найдено по запросу «{escaped_query}»: {total} (Страница {page + 1}/{total_pages})\n\n"]
+        for idx, (app_type, team_type, app) in enumerate(hits, page * SEARCH_PER_PAGE + 1):
+            category = TEAM_TYPES.get(team_type, team_type) if app_type == 'teammate' else "Клан"
+            parts.append(format_listing_entry(f"{idx}. [{category}]", app_type, app))
+        text = ''.join(parts)
+        nav_buttons = []
+        if page > 0:
+            nav_buttons.append(create_button("⬅️ Предыдущая", callback_data('search_page', page - 1)))
+        if (page + 1) * SEARCH_PER_PAGE < total:
+            nav_buttons.append(create_button("➡️ Следующая", callback_data('search_page', page + 1)))
+        if nav_buttons:
+            keyboard.append(nav_buttons)
+    else:
+        text = f"😔 По запросу «{escaped_query}» ничего не найдено. Попробуйте другие слова."
+    
+    keyboard.append([create_button("🔎 Новый поиск", 'search')])
+    keyboard.append([create_button("🏠 Главное меню", 'back_to_main')])
+    await reply_or_edit(update, text, InlineKeyboardMarkup(keyboard))
+    # Можно сразу ввести следующий запрос
+    return TYPING_SEARCH
+
+async def search_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
+    await safe_edit_message(query, SEARCH_PROMPT_TEXT, reply_markup=BACK_TO_MAIN_KEYBOARD)
+    return TYPING_SEARCH
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """/search [запрос]: без запроса просит его ввести."""
+    if not await check_subscription(update, context):
+        await send_welcome_message(update, context)
+        return ConversationHandler.END
     
-    context.user_data['page'] += 1
-    return await list_applications(update, context)
+    query_text = ' '.join(context.args or [])
+    if not query_text:
+        await update.message.reply_text(SEARCH_PROMPT_TEXT, reply_markup=BACK_TO_MAIN_KEYBOARD)
+        return TYPING_SEARCH
+    context.user_data['search_query'] = query_text[:SEARCH_MAX_QUERY_LENGTH]
+    return await show_search_results(update, context)
+
+async def search_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data['search_query'] = update.message.text[:SEARCH_MAX_QUERY_LENGTH]
+    return await show_search_results(update, context)
+
+async def search_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    try:
+        page = max(int(callback_args(update.callback_query.data)[0]), 0)
+    except (IndexError, ValueError):
+        page = 0
+    return await show_search_results(update, context, page)
 
 # Показать заявки пользователя
 async def my_applications(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -743,26 +2687,7 @@ async def my_applications(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         team_type = context.user_data.get('team_type', 'duo')
         app_type = context.user_data.get('app_type', 'teammate')
         
-        conn = sqlite3.connect('rust_bot.db')
-        cursor = conn.cursor()
-        
-        if app_type == 'teammate':
-            cursor.execute('''
-            SELECT id, age, hours, role, online, discord, date 
-            FROM applications 
-            WHERE user_id = ? AND team_type = ? AND app_type = ? AND is_active = 1
-            ORDER BY date DESC
-            ''', (user_id, team_type, app_type))
-        else:
-            cursor.execute('''
-            SELECT id, clan_name, leader_name, required, members_count, discord, date 
-            FROM applications 
-            WHERE user_id = ? AND app_type = ? AND is_active = 1
-            ORDER BY date DESC
-            ''', (user_id, app_type))
-        
-        apps = cursor.fetchall()
-        conn.close()
+        apps = active_apps.user_apps(user_id, app_type, team_type)
         
         if not apps:
             keyboard = [
@@ -777,6 +2702,7 @@ async def my_applications(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             )
             return CHOOSING
         
+        apps = [[html.escape(str(value)) for value in app] for app in apps]
         if app_type == 'teammate':
             apps_text = f"📋 Ваши заявки {TEAM_TYPES.get(team_type, team_type)}:\n\n"
             for app in apps:
@@ -805,8 +2731,8 @@ async def my_applications(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         keyboard = []
         for app in apps:
             keyboard.append([
-                create_button(f"✏️ Редактировать {app[0]}", f'edit_{app[0]}'),
-                create_button(f"❌ Удалить {app[0]}", f'delete_{app[0]}')
+                create_button(f"✏️ Редактировать {app[0]}", callback_data('edit', app[0])),
+                create_button(f"❌ Удалить {app[0]}", callback_data('delete', app[0]))
             ])
         
         keyboard.extend([
@@ -823,6 +2749,7 @@ async def my_applications(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return CHOOSING
     
     except Exception as e:
+        count_handler_error('my_applications')
         logger.error(f"Ошибка в my_applications: {e}")
         if update.callback_query:
             await safe_edit_message(
@@ -836,23 +2763,19 @@ async def edit_application(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     query = update.callback_query
     await query.answer()
     
-    app_id = int(query.data.split('_')[1])
+    app_id = int(callback_args(query.data)[0])
     context.user_data['editing_app_id'] = app_id
     
-    conn = sqlite3.connect('rust_bot.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT app_type FROM applications WHERE id = ?', (app_id,))
-    app_type = cursor.fetchone()[0]
+    app_row = await db.fetchone('''
+    SELECT app_type, age, hours, role, online, discord, 
+           clan_name, leader_name, required, members_count 
+    FROM applications 
+    WHERE id = ?
+    ''', (app_id,))
+    app_type = app_row[0]
     
     if app_type == 'teammate':
-        cursor.execute('''
-        SELECT age, hours, role, online, discord 
-        FROM applications 
-        WHERE id = ?
-        ''', (app_id,))
-        
-        app_data = cursor.fetchone()
+        app_data = app_row[1:6]
         message_text = (
             "✏️ Редактирование заявки:\n\n"
             "Введите новые данные (каждый пункт с новой строки):\n"
@@ -869,13 +2792,7 @@ async def edit_application(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             "exemple#Discord_Vasya"
         )
     else:
-        cursor.execute('''
-        SELECT clan_name, leader_name, required, members_count, discord 
-        FROM applications 
-        WHERE id = ?
-        ''', (app_id,))
-        
-        app_data = cursor.fetchone()
+        app_data = app_row[6:10] + app_row[5:6]
         message_text = (
             "✏️ Редактирование информации о клане:\n\n"
             "Введите новые данные (каждый пункт с новой строки):\n"
@@ -892,8 +2809,6 @@ async def edit_application(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             "clanleader#5678"
         )
     
-    conn.close()
-    
     keyboard = [
         [create_button("❌ Отменить редактирование", 'cancel_edit')],
         [create_button("🏠 Главное меню", 'back_to_main')]
@@ -919,25 +2834,39 @@ async def save_edited_application(update: Update, context: ContextTypes.DEFAULT_
             await update.message.reply_text("❌ Ошибка: не найден ID заявки.")
             return await start(update, context)
         
-        conn = sqlite3.connect('rust_bot.db')
-        cursor = conn.cursor()
+        def update_application(conn):
+            app_type, team_type = conn.execute(
+                'SELECT app_type, team_type FROM applications WHERE id = ?', (app_id,)
+            ).fetchone()
+            
+            if app_type == 'teammate':
+                conn.execute('''
+                UPDATE applications 
+                SET age = ?, hours = ?, role = ?, online = ?, discord = ?, date = ?, created_at = ?
+                WHERE id = ?
+                ''', (
+                    user_data[0].strip(), user_data[1].strip(), user_data[2].strip(),
+                    user_data[3].strip(), user_data[4].strip(), 
+                    datetime.now().strftime("%d.%m.%Y %H:%M"), int(time.time()), app_id
+                ))
+            else:
+                conn.execute('''
+                UPDATE applications 
+                SET clan_name = ?, leader_name = ?, required = ?, members_count = ?, discord = ?, date = ?, created_at = ?
+                WHERE id = ?
+                ''', (
+                    user_data[0].strip(), user_data[1].strip(), user_data[2].strip(),
+                    user_data[3].strip(), user_data[4].strip(), 
+                    datetime.now().strftime("%d.%m.%Y %H:%M"), int(time.time()), app_id
+                ))
+            store_parsed_application(conn, app_id, app_type, user_data)
+            return app_type, team_type, conn.execute(SQL_ACTIVE_APP, (app_id,)).fetchone()
         
-        cursor.execute('SELECT app_type FROM applications WHERE id = ?', (app_id,))
-        app_type = cursor.fetchone()[0]
+        app_type, team_type, row = await db.transaction(update_application)
+        active_apps.apply(app_id, row)
+        invalidate_category(app_type, team_type)
         
         if app_type == 'teammate':
-            cursor.execute('''
-            UPDATE applications 
-            SET age = ?, hours = ?, role = ?, online = ?, discord = ?, date = ?
-            WHERE id = ?
-            ''', (
-                user_data[0].strip(), user_data[1].strip(), user_data[2].strip(),
-                user_data[3].strip(), user_data[4].strip(), 
-                datetime.now().strftime("%d.%m.%Y %H:%M"), app_id
-            ))
-            
-            cursor.execute('SELECT team_type FROM applications WHERE id = ?', (app_id,))
-            team_type = cursor.fetchone()[0]
             context.user_data['team_type'] = team_type
             context.user_data['app_type'] = 'teammate'
             
@@ -951,16 +2880,6 @@ async def save_edited_application(update: Update, context: ContextTypes.DEFAULT_
                 f"📅 Дата обновления: {datetime.now().strftime('%d.%m.%Y %H:%M')}"
             )
         else:
-            cursor.execute('''
-            UPDATE applications 
-            SET clan_name = ?, leader_name = ?, required = ?, members_count = ?, discord = ?, date = ?
-            WHERE id = ?
-            ''', (
-                user_data[0].strip(), user_data[1].strip(), user_data[2].strip(),
-                user_data[3].strip(), user_data[4].strip(), 
-                datetime.now().strftime("%d.%m.%Y %H:%M"), app_id
-            ))
-            
             context.user_data['app_type'] = 'clan'
             
             response = (
@@ -973,13 +2892,11 @@ async def save_edited_application(update: Update, context: ContextTypes.DEFAULT_
                 f"📅 Дата обновления: {datetime.now().strftime('%d.%m.%Y %H:%M')}"
             )
         
-        conn.commit()
-        conn.close()
-        
         await update.message.reply_text(response)
         return await my_applications(update, context)
     
     except Exception as e:
+        count_handler_error('save_edited_application')
         logger.error(f"Ошибка при обновлении заявки: {e}")
         await update.message.reply_text("⚠️ Произошла ошибка при обновлении заявки. Попробуйте позже.")
         return await start(update, context)
@@ -989,58 +2906,50 @@ async def delete_application(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
     
-    app_id = int(query.data.split('_')[1])
+    app_id = int(callback_args(query.data)[0])
     user = query.from_user
     
-    conn = sqlite3.connect('rust_bot.db')
-    cursor = conn.cursor()
-    
-    # Получаем информацию о заявке перед удалением
-    cursor.execute('''
-    SELECT app_type, team_type, age, hours, role, online, discord, 
-           clan_name, leader_name, required, members_count 
-    FROM applications 
-    WHERE id = ?
-    ''', (app_id,))
-    
-    app_info = cursor.fetchone()
+    def deactivate(conn):
+        # Получаем информацию о заявке перед удалением
+        app_info = conn.execute('''
+        SELECT app_type, team_type, age, hours, role, online, discord, 
+               clan_name, leader_name, required, members_count 
+        FROM applications 
+        WHERE id = ?
+        ''', (app_id,)).fetchone()
+        
+        # Обновляем статус заявки (не удаляем полностью)
+        conn.execute('UPDATE applications SET is_active = 0 WHERE id = ?', (app_id,))
+        return app_info
     
-    # Обновляем статус заявки (не удаляем полностью)
-    cursor.execute('UPDATE applications SET is_active = 0 WHERE id = ?', (app_id,))
-    conn.commit()
-    conn.close()
+    app_info = await db.transaction(deactivate)
+    active_apps.remove(app_id)
+    invalidate_category(app_info[0], app_info[1])
     
     # Формируем сообщение для админского чата
     if app_info[0] == 'teammate':
         notification_text = (
             "🗑 <b>Заявка удалена</b>\n\n"
-            f"👤 Пользователь: @{user.username or user.first_name} (ID: {user.id})\n"
+            f"👤 Пользователь: @{html.escape(user.username or user.first_name)} (ID: {user.id})\n"
             f"📌 Тип: {TEAM_TYPES.get(app_info[1], app_info[1])}\n"
             f"🆔 ID заявки: {app_id}\n\n"
-            f"🎂 Возраст: {app_info[2]}\n"
-            f"⏱ Часов: {app_info[3]}\n"
-            f"🎮 Роль: {app_info[4]}\n"
-            f"⏳ Онлайн: {app_info[5]}\n"
-            f"📞 Discord: {app_info[6]}"
+            f"🎂 Возраст: {html.escape(str(app_info[2]))}\n"
+            f"⏱ Часов: {html.escape(str(app_info[3]))}\n"
+            f"🎮 Роль: {html.escape(str(app_info[4]))}\n"
+            f"⏳ Онлайн: {html.escape(str(app_info[5]))}\n"
+            f"📞 Discord: {html.escape(str(app_info[6]))}"
         )
     else:
         notification_text = (
             "🗑 <b>Заявка на клан удалена</b>\n\n"
-            f"👤 Пользователь: @{user.username or user.first_name} (ID: {user.id})\n"
+            f"👤 Пользователь: @{html.escape(user.username or user.first_name)} (ID: {user.id})\n"
             f"🆔 ID заявки: {app_id}\n"
-            f"🏰 Название клана: {app_info[7]}\n"
-            f"👑 Лидер: {app_info[8]}"
+            f"🏰 Название клана: {html.escape(str(app_info[7]))}\n"
+            f"👑 Лидер: {html.escape(str(app_info[8]))}"
         )
     
     # Отправляем уведомление в админский чат
-    try:
-        await context.bot.send_message(
-            chat_id=NOTIFICATION_CHAT_ID,
-            text=notification_text,
-            parse_mode='HTML'
-        )
-    except Exception as e:
-        logger.error(f"Ошибка при отправке уведомления в админский чат: {e}")
+    admin_notifier.notify('user_delete', notification_text)
     
     await safe_edit_message(
         query,
@@ -1055,13 +2964,7 @@ async def remove_from_search(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     user_id = query.from_user.id
     
-    conn = sqlite3.connect('rust_bot.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT 1 FROM applications WHERE user_id = ? AND is_active = 1', (user_id,))
-    has_apps = cursor.fetchone() is not None
-    
-    conn.close()
+    has_apps = active_apps.has_user_apps(user_id)
     
     keyboard = [
         [create_button("✅ Да, удалить мои заявки", 'confirm_remove')],
@@ -1089,21 +2992,18 @@ async def confirm_remove(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = query.from_user.id
     user = query.from_user
     
-    conn = sqlite3.connect('rust_bot.db')
-    cursor = conn.cursor()
-    
-    # Получаем все активные заявки пользователя перед удалением
-    cursor.execute('''
-    SELECT id, app_type, team_type FROM applications 
-    WHERE user_id = ? AND is_active = 1
-    ''', (user_id,))
-    
-    user_apps = cursor.fetchall()
+    def deactivate_all(conn):
+        # Получаем все активные заявки пользователя перед удалением
+        user_apps = conn.execute(SQL_USER_ACTIVE_APPS, (user_id,)).fetchall()
+        
+        # Обновляем статус заявок (не удаляем полностью)
+        conn.execute(SQL_DEACTIVATE_USER_APPS, (user_id,))
+        return user_apps
     
-    # Обновляем статус заявок (не удаляем полностью)
-    cursor.execute('UPDATE applications SET is_active = 0 WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    user_apps = await db.transaction(deactivate_all)
+    for app_id, app_type, team_type in user_apps:
+        active_apps.remove(app_id)
+        invalidate_category(app_type, team_type)
     
     # Формируем сообщение для админского чата
     if user_apps:
@@ -1113,20 +3013,13 @@ async def confirm_remove(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         notification_text = (
             "🗑 <b>Пользователь удалил все свои заявки</b>\n\n"
-            f"👤 Пользователь: @{user.username or user.first_name} (ID: {user.id})\n"
+            f"👤 Пользователь: @{html.escape(user.username or user.first_name)} (ID: {user.id})\n"
             f"🔢 Количество заявок: {len(user_apps)}\n\n"
             f"📋 Список удаленных заявок:\n{apps_list}"
         )
         
         # Отправляем уведомление в админский чат
-        try:
-            await context.bot.send_message(
-                chat_id=NOTIFICATION_CHAT_ID,
-                text=notification_text,
-                parse_mode='HTML'
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при отправке уведомления в админский чат: {e}")
+        admin_notifier.notify('user_delete', notification_text)
     
     await safe_edit_message(
         query,
@@ -1149,23 +3042,10 @@ async def guide(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     
-    guide_text = (
-        "📚 Гайд по боту:\n\n"
-        "1. Используйте кнопки для навигации\n"
-        "2. Заполняйте заявки полностью и правдиво\n"
-        "3. Для выхода используйте 'Удалиться из поиска'\n"
-        "4. Не указывайте личную информацию кроме Discord\n"
-        "5. Будьте вежливы с другими игроками\n"
-        "6. Если что-то не работает, удалите чат и заново войдите\n\n"
-        "Приятной игры! 🎮"
-    )
-    
-    keyboard = [[create_button("🔙 Назад в главное меню", 'back_to_main')]]
-    
     await safe_edit_message(
         query,
-        guide_text,
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        GUIDE_TEXT,
+        reply_markup=BACK_TO_MAIN_KEYBOARD
     )
     return CHOOSING
 
@@ -1175,24 +3055,16 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     await query.answer()
     
     user = update.effective_user
-    if str(user.id) not in ADMIN_IDS.split(','):
+    if not is_admin(user.id):
         await query.edit_message_text("⛔ У вас нет прав доступа к этой панели.")
         return await start(update, context)
     
     admin_text = f"👑 <b>МЕНЮ АДМИНИСТРАТОРА БОТА</b>:\n\nТекущий период автоудаления: {AUTO_DELETE_DAYS} дней"
     
-    keyboard = [
-        [create_button("📋 Полный список заявок", 'admin_all_apps')],
-        [create_button("🕒 Изменить период автоудаления", 'admin_set_autodelete')],
-        [create_button("⚠️ Список жалоб", 'admin_complaints')],
-        [create_button("🏆 Конкурсы", 'admin_contests')],
-        [create_button("🔙 Назад", 'back_to_main')]
-    ]
-    
     await safe_edit_message(
         query,
         admin_text,
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=ADMIN_PANEL_KEYBOARD
     )
     return CHOOSING
 
@@ -1201,26 +3073,16 @@ async def admin_set_autodelete(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.answer()
     
     user = update.effective_user
-    if str(user.id) not in ADMIN_IDS.split(','):
+    if not is_admin(user.id):
         await query.edit_message_text("⛔ У вас нет прав доступа к этой панели.")
         return await start(update, context)
     
     message_text = f"🕒 Текущий период автоудаления: {AUTO_DELETE_DAYS} дней\n\nВыберите новый период:"
     
-    keyboard = [
-        [create_button("1 день", 'admin_set_days_1')],
-        [create_button("2 дня", 'admin_set_days_2')],
-        [create_button("3 дня", 'admin_set_days_3')],
-        [create_button("4 дня", 'admin_set_days_4')],
-        [create_button("5 дней", 'admin_set_days_5')],
-        [create_button("7 дней", 'admin_set_days_7')],
-        [create_button("🔙 Назад", 'admin_panel')]
-    ]
-    
     await safe_edit_message(
         query,
         message_text,
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=AUTODELETE_KEYBOARD
     )
     return CHOOSING
 
@@ -1229,44 +3091,23 @@ async def admin_set_days(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await query.answer()
     
     global AUTO_DELETE_DAYS
-    days = int(query.data.split('_')[-1])
+    days = int(callback_args(query.data)[0])
     AUTO_DELETE_DAYS = days
     
-    # Сохраняем настройку в базу данных
-    conn = sqlite3.connect('rust_bot.db')
-    cursor = conn.cursor()
-    
-    # Создаем таблицу для настроек, если ее нет
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS bot_settings (
-        key TEXT PRIMARY KEY,
-        value TEXT
-    )''')
-    
-    # Сохраняем значение
-    cursor.execute('''
+    # Сохраняем настройку в базу данных (таблица создается в init_db)
+    await db.execute('''
     INSERT OR REPLACE INTO bot_settings (key, value) 
     VALUES ('auto_delete_days', ?)
     ''', (str(days),))
     
-    conn.commit()
-    conn.close()
-    
     # Отправляем уведомление в админский чат
     notification_text = (
         f"⚙️ <b>Изменен период автоудаления</b>\n\n"
-        f"👤 Администратор: @{query.from_user.username or query.from_user.first_name}\n"
+        f"👤 Администратор: @{html.escape(query.from_user.username or query.from_user.first_name)}\n"
         f"🕒 Новый период: {days} дней"
     )
     
-    try:
-        await context.bot.send_message(
-            chat_id=NOTIFICATION_CHAT_ID,
-            text=notification_text,
-            parse_mode='HTML'
-        )
-    except Exception as e:
-        logger.error(f"Ошибка при отправке уведомления в админский чат: {e}")
+    admin_notifier.notify('settings', notification_text)
     
     await safe_edit_message(
         query,
@@ -1279,7 +3120,7 @@ async def admin_delete_app(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     await query.answer()
     
     user = update.effective_user
-    if str(user.id) not in ADMIN_IDS.split(','):
+    if not is_admin(user.id):
         await query.edit_message_text("⛔ У вас нет прав доступа к этой панели.")
         return await start(update, context)
     
@@ -1293,6 +3134,7 @@ async def admin_delete_app(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
     context.user_data['awaiting_app_id'] = True
+    context.user_data.pop('awaiting_user_filter', None)
     return TYPING_ADMIN_INPUT
 
 async def admin_confirm_delete_app(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1300,13 +3142,7 @@ async def admin_confirm_delete_app(update: Update, context: ContextTypes.DEFAULT
         app_id = int(update.message.text)
         context.user_data['app_to_delete'] = app_id
         
-        conn = sqlite3.connect('rust_bot.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT 1 FROM applications WHERE id = ? AND is_active = 1', (app_id,))
-        exists = cursor.fetchone()
-        conn.close()
-        
-        if not exists:
+        if app_id not in active_apps:
             await update.message.reply_text("❌ Заявка не найдена или уже удалена.")
             return await admin_all_applications(update, context)
             
@@ -1336,29 +3172,29 @@ async def admin_execute_delete(update: Update, context: ContextTypes.DEFAULT_TYP
     
     user = update.effective_user
     
-    conn = sqlite3.connect('rust_bot.db')
-    cursor = conn.cursor()
-    
-    # Получаем информацию о заявке перед удалением
-    cursor.execute('''
-    SELECT a.user_id, u.username, a.app_type, a.team_type, a.clan_name, a.leader_name
-    FROM applications a
-    JOIN users u ON a.user_id = u.user_id
-    WHERE a.id = ? AND a.is_active = 1
-    ''', (app_id,))
+    def deactivate(conn):
+        # Получаем информацию о заявке перед удалением
+        app_info = conn.execute('''
+        SELECT a.user_id, u.username, a.app_type, a.team_type, a.clan_name, a.leader_name
+        FROM applications a
+        JOIN users u ON a.user_id = u.user_id
+        WHERE a.id = ? AND a.is_active = 1
+        ''', (app_id,)).fetchone()
+        
+        if app_info:
+            # Удаляем заявку
+            conn.execute('UPDATE applications SET is_active = 0 WHERE id = ?', (app_id,))
+        return app_info
     
-    app_info = cursor.fetchone()
+    app_info = await db.transaction(deactivate)
     
     if not app_info:
         await query.edit_message_text("❌ Заявка не найдена или уже удалена.")
         return await admin_all_applications(update, context)
     
     user_id, username, app_type, team_type, clan_name, leader_name = app_info
-    
-    # Удаляем заявку
-    cursor.execute('UPDATE applications SET is_active = 0 WHERE id = ?', (app_id,))
-    conn.commit()
-    conn.close()
+    active_apps.remove(app_id)
+    invalidate_category(app_type, team_type)
     
     # Уведомляем пользователя
     try:
@@ -1371,88 +3207,83 @@ async def admin_execute_delete(update: Update, context: ContextTypes.DEFAULT_TYP
     if app_type == 'teammate':
         notification_text = (
             "🗑 <b>Заявка удалена администратором</b>\n\n"
-            f"👤 Администратор: @{user.username or user.first_name}\n"
-            f"👤 Пользователь: @{username} (ID: {user_id})\n"
+            f"👤 Администратор: @{html.escape(user.username or user.first_name)}\n"
+            f"👤 Пользователь: @{html.escape(str(username))} (ID: {user_id})\n"
             f"🆔 ID заявки: {app_id}\n"
             f"📌 Тип: {TEAM_TYPES.get(team_type, team_type)}"
         )
     else:
         notification_text = (
             "🗑 <b>Заявка на клан удалена администратором</b>\n\n"
-            f"👤 Администратор: @{user.username or user.first_name}\n"
-            f"👤 Пользователь: @{username} (ID: {user_id})\n"
+            f"👤 Администратор: @{html.escape(user.username or user.first_name)}\n"
+            f"👤 Пользователь: @{html.escape(str(username))} (ID: {user_id})\n"
             f"🆔 ID заявки: {app_id}\n"
-            f"🏰 Название клана: {clan_name}\n"
-            f"👑 Лидер: {leader_name}"
+            f"🏰 Название клана: {html.escape(str(clan_name))}\n"
+            f"👑 Лидер: {html.escape(str(leader_name))}"
         )
     
-    try:
-        await context.bot.send_message(
-            chat_id=NOTIFICATION_CHAT_ID,
-            text=notification_text,
-            parse_mode='HTML'
-        )
-    except Exception as e:
-        logger.error(f"Ошибка при отправке уведомления в админский чат: {e}")
+    admin_notifier.notify('admin_delete', notification_text)
     
     await query.edit_message_text(f"✅ Заявка {app_id} успешно удалена.")
     return await admin_all_applications(update, context)
 
-async def admin_all_applications(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+ADMIN_APPS_PER_PAGE = 10
+
+ADMIN_STATUS_LABELS = {None: 'все', 1: 'активные', 0: 'неактивные'}
+
+async def admin_all_applications(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                 page=0, direction=None, cursor=None) -> int:
     query = update.callback_query
-    await query.answer()
+    if query:
+        await query.answer()
     
     user = update.effective_user
-    if str(user.id) not in ADMIN_IDS.split(','):
+    if not is_admin(user.id):
         await query.edit_message_text("⛔ У вас нет прав доступа к этой панели.")
         return await start(update, context)
     
-    page = context.user_data.get('admin_page', 0)
-    apps_per_page = 10
-    
-    conn = sqlite3.connect('rust_bot.db')
-    cursor = conn.cursor()
-    
-    # Получаем общее количество заявок
-    cursor.execute('SELECT COUNT(*) FROM applications')
-    total_apps = cursor.fetchone()[0]
-    
-    # Получаем заявки для текущей страницы
-    cursor.execute('''
-    SELECT a.id, u.username, a.app_type, a.team_type, a.date, a.is_active 
-    FROM applications a
-    JOIN users u ON a.user_id = u.user_id
-    ORDER BY a.date DESC
-    LIMIT ? OFFSET ?
-    ''', (apps_per_page, page * apps_per_page))
+    admin_filters = context.user_data.setdefault('admin_filters', {})
+    queries, params = build_admin_apps_queries(admin_filters)
+    apps, page, has_newer, has_older = await fetch_keyset_page(
+        sql_page_fetcher(queries, params), ADMIN_APPS_PER_PAGE, page, direction, cursor
+    )
     
-    apps = cursor.fetchall()
-    conn.close()
+    # Кнопки фильтров показываются всегда, чтобы пустой результат можно было сбросить
+    type_filter = admin_filters.get('type')
+    filter_keyboard = [
+        [create_button(f"📊 Статус: {ADMIN_STATUS_LABELS[admin_filters.get('status')]}", callback_data('admin_filter', 'status')),
+         create_button(f"📌 Тип: {TEAM_TYPES.get(type_filter, 'все')}", callback_data('admin_filter', 'type'))],
+        [create_button(f"👤 Пользователь: {admin_filters.get('user_id') or 'все'}", callback_data('admin_filter', 'user')),
+         create_button("♻️ Сбросить фильтры", callback_data('admin_filter', 'reset'))],
+    ]
     
     if not apps:
-        await safe_edit_message(
-            query,
-            "ℹ️ В базе нет заявок.",
-            reply_markup=InlineKeyboardMarkup([[create_button("🔙 Назад", 'admin_panel')]])
-        )
+        keyboard = filter_keyboard + [[create_button("🔙 Назад", 'admin_panel')]]
+        await reply_or_edit(update, "ℹ️ В базе нет заявок.", InlineKeyboardMarkup(keyboard))
         return CHOOSING
     
-    apps_text = f"📋 <b>Список заявок (страница {page + 1}/{(total_apps + apps_per_page - 1) // apps_per_page}):</b>\n\n"
+    # Общее количество берется из счетчиков, а не пересчитывается по таблице
+    total_apps = await count_admin_applications(admin_filters)
+    total_pages = max((total_apps + ADMIN_APPS_PER_PAGE - 1) // ADMIN_APPS_PER_PAGE, page + 1)
+    
+    apps_text = f"📋 <b>Список заявок (страница {page + 1}/{total_pages}):</b>\n\n"
     for app in apps:
-        status = "✅ Активна" if app[5] else "❌ Неактивна"
+        status = "✅ Активна" if app[6] else "❌ Неактивна"
         apps_text += (
-            f"🆔 {app[0]} | 👤 {app[1]} | "
-            f"📌 {app[2]}{'/'+app[3] if app[3] else ''} | "
-            f"📅 {app[4]} | {status}\n"
+            f"🆔 {app[0]} | 👤 {html.escape(str(app[2]))} | "
+            f"📌 {app[3]}{'/'+app[4] if app[4] else ''} | "
+            f"📅 {app[5]} | {status}\n"
         )
     
     keyboard = []
     
-    # Кнопки навигации по страницам
-    if page > 0:
-        keyboard.append([create_button("⬅️ Предыдущая страница", 'admin_prev_page')])
-    if (page + 1) * apps_per_page < total_apps:
-        keyboard.append([create_button("➡️ Следующая страница", 'admin_next_page')])
+    # Кнопки навигации по страницам передают ключ граничной заявки
+    if has_newer:
+        keyboard.append([create_button("⬅️ Предыдущая страница", callback_data('admin_prev_page', page, apps[0][1], apps[0][0]))])
+    if has_older:
+        keyboard.append([create_button("➡️ Следующая страница", callback_data('admin_next_page', page, apps[-1][1], apps[-1][0]))])
+    
+    keyboard.extend(filter_keyboard)
     
     # Кнопка удаления заявки
     keyboard.append([create_button("🗑 Удалить заявку", 'admin_delete_app')])
@@ -1461,33 +3292,86 @@ async def admin_all_applications(update: Update, context: ContextTypes.DEFAULT_T
     
     context.user_data['admin_page'] = page
     
-    await safe_edit_message(
-        query,
-        apps_text,
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+    await reply_or_edit(update, apps_text, InlineKeyboardMarkup(keyboard))
     return CHOOSING
 
+async def reply_or_edit(update: Update, text, reply_markup=None):
+    # Админ-список открывается и кнопкой, и после ввода ID в сообщении
+    if update.callback_query:
+        await safe_edit_message(update.callback_query, text, reply_markup=reply_markup)
+    else:
+        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='HTML')
+
 async def admin_next_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    try:
+        page, cursor = parse_page_callback(update.callback_query.data)
+    except ValueError:
+        return await admin_all_applications(update, context)
+    return await admin_all_applications(update, context, page=page, direction='after', cursor=cursor)
+
+async def admin_prev_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    try:
+        page, cursor = parse_page_callback(update.callback_query.data)
+    except ValueError:
+        return await admin_all_applications(update, context)
+    return await admin_all_applications(update, context, page=page, direction='before', cursor=cursor)
+
+async def admin_filter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    await query.answer()
     
-    context.user_data['admin_page'] = context.user_data.get('admin_page', 0) + 1
+    user = update.effective_user
+    if not is_admin(user.id):
+        await query.answer()
+        await query.edit_message_text("⛔ У вас нет прав доступа к этой панели.")
+        return await start(update, context)
+    
+    admin_filters = context.user_data.setdefault('admin_filters', {})
+    action = callback_args(query.data)[0]
+    
+    if action == 'status':
+        current = ADMIN_STATUS_FILTERS.index(admin_filters.get('status'))
+        admin_filters['status'] = ADMIN_STATUS_FILTERS[(current + 1) % len(ADMIN_STATUS_FILTERS)]
+    elif action == 'type':
+        current = ADMIN_TYPE_FILTERS.index(admin_filters.get('type'))
+        admin_filters['type'] = ADMIN_TYPE_FILTERS[(current + 1) % len(ADMIN_TYPE_FILTERS)]
+    elif action == 'user':
+        await query.answer()
+        keyboard = [[create_button("🔙 Назад к списку", 'admin_all_apps')]]
+        await safe_edit_message(
+            query,
+            "👤 Введите ID пользователя, заявки которого нужно показать:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        context.user_data['awaiting_user_filter'] = True
+        return TYPING_ADMIN_INPUT
+    elif action == 'reset':
+        admin_filters.clear()
+    
     return await admin_all_applications(update, context)
 
-async def admin_prev_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
+async def admin_set_user_filter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    try:
+        user_id = int(update.message.text)
+    except ValueError:
+        await update.message.reply_text("❌ Неверный формат ID. Введите число.")
+        context.user_data['awaiting_user_filter'] = True
+        return TYPING_ADMIN_INPUT
     
-    context.user_data['admin_page'] = max(0, context.user_data.get('admin_page', 0) - 1)
+    context.user_data.setdefault('admin_filters', {})['user_id'] = user_id
     return await admin_all_applications(update, context)
 
+async def admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Текстовый ввод в админ-панели: ID пользователя для фильтра или ID заявки для удаления."""
+    if context.user_data.pop('awaiting_user_filter', False):
+        return await admin_set_user_filter(update, context)
+    return await admin_confirm_delete_app(update, context)
+
 async def admin_complaints(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     
     user = update.effective_user
-    if str(user.id) not in ADMIN_IDS.split(','):
+    if not is_admin(user.id):
         await query.edit_message_text("⛔ У вас нет прав доступа к этой панели.")
         return await start(update, context)
     
@@ -1511,7 +3395,7 @@ async def admin_contests(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await query.answer()
     
     user = update.effective_user
-    if str(user.id) not in ADMIN_IDS.split(','):
+    if not is_admin(user.id):
         await query.edit_message_text("⛔ У вас нет прав доступа к этой панели.")
         return await start(update, context)
     
@@ -1548,8 +3432,426 @@ async def back_from_clan_list(update: Update, context: ContextTypes.DEFAULT_TYPE
     """Возвращает в меню выбора действий для клана."""
     return await find_clan(update, context)
 
-def main() -> None:
-    application = ApplicationBuilder().token("118050186477:AAHaULshRa8ZdnIe8SV5sAEjjBwT487FtCw").build()
+# Параллельная обработка обновлений
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает обновления разных пользователей параллельно, а обновления
+    одного пользователя - строго по очереди, чтобы не ломать состояние ConversationHandler.
+
+    Базовый семафор ограничивает число принятых обновлений (max_pending),
+    а собственный - число одновременно выполняемых (max_concurrent). Ожидающие
+    своей очереди обновления одного пользователя не занимают рабочие слоты.
+    """
+
+    def __init__(self, max_concurrent=UPDATE_CONCURRENCY, max_pending=UPDATE_MAX_PENDING):
+        super().__init__(max_pending)
+        self._workers = asyncio.Semaphore(max_concurrent)
+        self._user_locks = {}
+        self._user_waiters = {}
+        self.pending = 0
+        self.running = 0
+        # Сколько обновлений начали обрабатываться с запуска, не сбрасывается
+        self.started_total = 0
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_started = time.monotonic()
+        self._peak_pending = self.pending
+        self._processed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    @staticmethod
+    def _update_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._update_key(update)
+        received_at = time.monotonic()
+        self.pending += 1
+        self._peak_pending = max(self._peak_pending, self.pending)
+
+        if key is None:
+            lock = None
+        else:
+            lock = self._user_locks.get(key)
+            if lock is None:
+                lock = self._user_locks[key] = asyncio.Lock()
+            self._user_waiters[key] = self._user_waiters.get(key, 0) + 1
+
+        started = False
+        try:
+            if lock is not None:
+                await lock.acquire()
+            try:
+                async with self._workers:
+                    wait = time.monotonic() - received_at
+                    started = True
+                    self.pending -= 1
+                    self.running += 1
+                    self.started_total += 1
+                    self._processed += 1
+                    self._wait_total += wait
+                    self._wait_max = max(self._wait_max, wait)
+                    try:
+                        await coroutine
+                    finally:
+                        self.running -= 1
+            finally:
+                if lock is not None:
+                    lock.release()
+        finally:
+            if not started:
+                # Отменено до начала обработки
+                self.pending -= 1
+            if key is not None:
+                self._user_waiters[key] -= 1
+                if not self._user_waiters[key]:
+                    del self._user_waiters[key]
+                    del self._user_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self, reset=False):
+        """Глубина очереди и время ожидания обновлений с момента последнего сброса."""
+        stats = {
+            'pending': self.pending,
+            'running': self.running,
+            'peak_pending': self._peak_pending,
+            'processed': self._processed,
+            'avg_wait': self._wait_total / self._processed if self._processed else 0.0,
+            'max_wait': self._wait_max,
+            'window': time.monotonic() - self._window_started,
+        }
+        if reset:
+            self._reset_window()
+        return stats
+
+update_processor = UserOrderedUpdateProcessor()
+metrics.gauge('bot_updates_pending', lambda: update_processor.pending)
+metrics.gauge('bot_updates_running', lambda: update_processor.running)
+metrics.gauge('bot_updates_started', lambda: update_processor.started_total)
+
+async def log_update_metrics(context: ContextTypes.DEFAULT_TYPE) -> None:
+    stats = update_processor.stats(reset=True)
+    logger.info(
+        f"Обновления за {stats['window']:.0f} с: обработано {stats['processed']}, "
+        f"в очереди {stats['pending']} (пик {stats['peak_pending']}), выполняется {stats['running']}, "
+        f"ожидание среднее {stats['avg_wait'] * 1000:.0f} мс, макс. {stats['max_wait'] * 1000:.0f} мс"
+    )
+
+# Встроенный HTTP-сервер для вебхука
+class HttpServer:
+    """Минимальный HTTP/1.1-сервер на asyncio: одно обращение на соединение."""
+
+    MAX_BODY_SIZE = 1024 * 1024
+    READ_TIMEOUT = 10
+
+    def __init__(self, host, port, max_connections):
+        self.host = host
+        self.port = port
+        self.routes = {}
+        self._server = None
+        self._connections = set()
+        self._semaphore = asyncio.Semaphore(max_connections)
+
+    def route(self, path, handler):
+        """handler(method, headers, body) -> (status, body, content_type)"""
+        self.routes[path] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        # При port=0 система выбирает свободный порт
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Перестает принимать соединения и дожидается ответа на уже принятые."""
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        if self._connections:
+            await asyncio.wait(self._connections)
+        self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            async with self._semaphore:
+                try:
+                    status, body, content_type = await asyncio.wait_for(
+                        self._handle_request(reader), self.READ_TIMEOUT
+                    )
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+                    status, body, content_type = 400, b'', 'text/plain'
+                writer.write(
+                    f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n'
+                    f'Content-Type: {content_type}\r\n'
+                    f'Content-Length: {len(body)}\r\n'
+                    'Connection: close\r\n\r\n'.encode('latin-1') + body
+                )
+                await writer.drain()
+        except ConnectionError:
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка HTTP-сервера: {e}")
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _handle_request(self, reader):
+        request_line = await reader.readline()
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        
+        length = int(headers.get('content-length', 0))
+        if length > self.MAX_BODY_SIZE:
+            return 413, b'', 'text/plain'
+        body = await reader.readexactly(length) if length else b''
+        
+        handler = self.routes.get(target.split('?', 1)[0])
+        if handler is None:
+            return 404, b'', 'text/plain'
+        return await handler(method, headers, body)
+
+async def handle_metrics(method, headers, body):
+    if method != 'GET':
+        return 405, b'', 'text/plain'
+    return 200, metrics.render().encode(), 'text/plain; version=0.0.4'
+
+metrics_server = None
+
+class InstrumentedRequest(BaseRequest):
+    """Обертка над сетевым слоем бота: время запросов к Bot API идет в фазу api обработчика."""
+
+    def __init__(self, request):
+        self._request = request
+
+    @property
+    def read_timeout(self):
+        return self._request.read_timeout
+
+    async def initialize(self):
+        await self._request.initialize()
+
+    async def shutdown(self):
+        await self._request.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        started = time.perf_counter()
+        try:
+            return await self._request.do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout
+            )
+        finally:
+            add_phase_time('api', started)
+
+def is_loopback_address(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def make_webhook_handler(application, secret_token):
+    secret = secret_token.encode()
+    
+    async def handle_webhook(method, headers, body):
+        if method != 'POST':
+            return 405, b'', 'text/plain'
+        received_secret = headers.get('x-telegram-bot-api-secret-token', '').encode('latin-1')
+        if secret and not hmac.compare_digest(received_secret, secret):
+            return 403, b'', 'text/plain'
+        if application.update_queue.qsize() + update_processor.pending >= WEBHOOK_MAX_PENDING_UPDATES:
+            return 503, b'', 'text/plain'
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.error(f"Некорректное обновление в вебхуке: {e}")
+            return 400, b'', 'text/plain'
+        await application.update_queue.put(update)
+        return 200, b'', 'text/plain'
+    
+    return handle_webhook
+
+async def run_webhook(application) -> None:
+    """Запускает бота в режиме вебхука. Хуки post_* здесь вызываются вручную,
+    так как Application вызывает их только из run_polling/run_webhook."""
+    secret_token = WEBHOOK_SECRET_TOKEN
+    if WEBHOOK_URL and not secret_token:
+        secret_token = secrets.token_urlsafe(32)
+        logger.info("WEBHOOK_SECRET_TOKEN не задан - для вебхука сгенерирован случайный токен")
+    listen = WEBHOOK_LISTEN
+    if not secret_token and not is_loopback_address(listen):
+        # Без проверки токена любой, кто достучится до порта, мог бы слать обновления от имени админов
+        logger.warning(f"WEBHOOK_SECRET_TOKEN не задан - вебхук слушает 127.0.0.1 вместо {listen}")
+        listen = '127.0.0.1'
+    server = HttpServer(listen, WEBHOOK_PORT, WEBHOOK_MAX_CONNECTIONS)
+    server.route(WEBHOOK_PATH, make_webhook_handler(application, secret_token))
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: остановка по Ctrl+C через KeyboardInterrupt
+            pass
+    
+    await application.initialize()
+    try:
+        await on_startup(application)
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+        await application.start()
+        await server.start()
+        logger.info(f"Бот запущен в режиме вебхука на {listen}:{server.port}{WEBHOOK_PATH}")
+        try:
+            await stop_event.wait()
+        finally:
+            # Сначала перестаем принимать обновления, затем Application.stop()
+            # обрабатывает все, что уже попало в очередь
+            logger.info("Остановка: дожидаемся обработки принятых обновлений...")
+            await server.stop()
+            if application.running:
+                await application.stop()
+            await on_stop(application)
+    finally:
+        await application.shutdown()
+        await close_db(application)
+
+async def on_startup(application) -> None:
+    global metrics_server
+    broadcaster.start(application.bot)
+    if METRICS_PORT is not None:
+        metrics_server = HttpServer(METRICS_LISTEN, METRICS_PORT, max_connections=4)
+        metrics_server.route('/metrics', handle_metrics)
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            logger.error(f"Не удалось запустить /metrics на {METRICS_LISTEN}:{METRICS_PORT}: {e}")
+            metrics_server = None
+
+async def on_stop(application) -> None:
+    global metrics_server
+    # Недоотправленная сводка и подобранные тиммейты попадают в outbox до остановки рассылки
+    await admin_notifier.stop()
+    await teammate_matcher.stop()
+    await broadcaster.stop()
+    if metrics_server is not None:
+        await metrics_server.stop()
+        metrics_server = None
+
+async def close_db(application) -> None:
+    await user_registry.flush()
+    db.close()
+
+# Обработчики кнопок в состоянии CHOOSING по действию из callback_data
+CHOOSING_CALLBACKS = {
+    'find_teammate': find_teammate,
+    'find_clan': find_clan,
+    'remove_from_search': remove_from_search,
+    'guide': guide,
+    
+    # Админ-панель
+    'admin_panel': admin_panel,
+    'admin_complaints': admin_complaints,
+    'admin_contests': admin_contests,
+    'admin_set_autodelete': admin_set_autodelete,
+    'admin_delete_app': admin_delete_app,
+    'admin_set_days': admin_set_days,
+    'admin_all_apps': admin_all_applications,
+    'admin_next_page': admin_next_page,
+    'admin_prev_page': admin_prev_page,
+    'admin_filter': admin_filter,
+    'admin_execute_delete': admin_execute_delete,
+    
+    # Кнопки "Назад"
+    'back_to_teammate': find_teammate,
+    'back_to_clan': find_clan,
+    'back_from_clan_list': back_from_clan_list,
+    'back_to_main': start,
+    
+    # Клан
+    'apply_clan': apply_application,
+    'list_clan': list_applications,
+    'my_apps_clan': my_apps_clan,
+    
+    # Общие обработчики
+    'edit': edit_application,
+    'delete': delete_application,
+    'confirm_remove': confirm_remove,
+    'cancel_remove': cancel_remove,
+    'prev_page': handle_prev_page,
+    'next_page': handle_next_page,
+    'list_filters': list_filters,
+    'list_filtered': list_filtered,
+    'list_best': list_best,
+    'search': search_prompt,
+    'search_page': search_page,
+    'cancel_edit': cancel_edit,
+}
+
+# Тиммейты: меню типа команды и его действия
+for _team_type in TEAM_MENUS:
+    CHOOSING_CALLBACKS[_team_type] = team_menu
+    CHOOSING_CALLBACKS[f'back_to_{_team_type}'] = team_menu
+    CHOOSING_CALLBACKS[f'apply_{_team_type}'] = apply_application
+    CHOOSING_CALLBACKS[f'list_{_team_type}'] = list_applications
+    CHOOSING_CALLBACKS[f'my_apps_{_team_type}'] = my_applications
+
+# Метрики пишутся под именем обработчика, а не общего маршрутизатора
+CHOOSING_CALLBACKS = {action: timed_handler(handler) for action, handler in CHOOSING_CALLBACKS.items()}
+
+async def route_choosing_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    data = update.callback_query.data or ''
+    handler = CHOOSING_CALLBACKS.get(data.split(CALLBACK_SEPARATOR, 1)[0])
+    if handler is None:
+        # Кнопка из старого сообщения или неизвестное действие - возвращаем в главное меню
+        logger.warning(f"Неизвестная кнопка: {data!r}")
+        return await start(update, context)
+    return await handler(update, context)
+
+def build_application(request=None):
+    """Создает Application со всеми обработчиками. request позволяет подменить
+    сетевой слой бота, например для локальной проверки без Telegram."""
+    builder = (
+        ApplicationBuilder()
+        .token("118050186477:AAHaULshRa8ZdnIe8SV5sAEjjBwT487FtCw")
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(close_db)
+        .concurrent_updates(update_processor)
+        .persistence(SQLitePersistence())
+    )
+    # Запросы обработчиков к Bot API замеряются для метрик; long polling - нет
+    builder = builder.request(InstrumentedRequest(request or HTTPXRequest(connection_pool_size=BOT_CONNECTION_POOL_SIZE)))
+    if request is not None:
+        builder = builder.get_updates_request(request)
+    application = builder.build()
     
     async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
         logger.error(msg="Exception while handling an update:", exc_info=context.error)
@@ -1568,93 +3870,75 @@ def main() -> None:
             interval=CHECK_OLD_APPLICATIONS_INTERVAL,
             first=10
         )
+        application.job_queue.run_repeating(flush_users, interval=USERS_FLUSH_INTERVAL, first=USERS_FLUSH_INTERVAL)
+        # Однократный перенос старых строковых дат; повторный запуск ничего не делает
+        application.job_queue.run_once(migrate_dates_to_epoch, when=0)
+        application.job_queue.run_once(backfill_parsed_fields, when=1)
+        application.job_queue.run_once(backfill_subscriptions, when=60)
+        application.job_queue.run_repeating(check_active_apps, interval=ACTIVE_APPS_CHECK_INTERVAL, first=ACTIVE_APPS_CHECK_INTERVAL)
+        application.job_queue.run_repeating(log_update_metrics, interval=UPDATE_METRICS_INTERVAL, first=UPDATE_METRICS_INTERVAL)
+        if QUERY_PROFILING:
+            application.job_queue.run_repeating(report_query_stats, interval=QUERY_REPORT_INTERVAL, first=QUERY_REPORT_INTERVAL)
     else:
         logger.warning("JobQueue не доступен. Автоматическое удаление старых заявок не будет работать.")
     
     # Настройка ConversationHandler
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
+        entry_points=[
+            CommandHandler('start', timed_handler(start)),
+            CommandHandler('search', timed_handler(search_command)),
+        ],
         states={
             CHOOSING: [
-                CallbackQueryHandler(find_teammate, pattern='^find_teammate$'),
-                CallbackQueryHandler(find_clan, pattern='^find_clan$'),
-                CallbackQueryHandler(remove_from_search, pattern='^remove_from_search$'),
-                CallbackQueryHandler(guide, pattern='^guide$'),
-                CallbackQueryHandler(admin_panel, pattern='^admin_panel$'),
-                CallbackQueryHandler(admin_complaints, pattern='^admin_complaints$'),
-                CallbackQueryHandler(admin_contests, pattern='^admin_contests$'),
-                CallbackQueryHandler(admin_set_autodelete, pattern='^admin_set_autodelete$'),
-                CallbackQueryHandler(admin_delete_app, pattern='^admin_delete_app$'),
-                CallbackQueryHandler(admin_set_days, pattern='^admin_set_days_'),
-                CallbackQueryHandler(admin_all_applications, pattern='^admin_all_apps$'),
-                CallbackQueryHandler(admin_next_page, pattern='^admin_next_page$'),
-                CallbackQueryHandler(admin_prev_page, pattern='^admin_prev_page$'),
-                CallbackQueryHandler(admin_execute_delete, pattern='^admin_execute_delete$'),
-                
-                # Обработчики для типов команд
-                CallbackQueryHandler(duo, pattern='^duo$'),
-                CallbackQueryHandler(trio, pattern='^trio$'),
-                CallbackQueryHandler(quad, pattern='^quad$'),
-                CallbackQueryHandler(quad_plus, pattern='^quad_plus$'),
-                
-                # Обработчики для кнопок "Назад"
-                CallbackQueryHandler(find_teammate, pattern='^back_to_teammate$'),
-                CallbackQueryHandler(duo, pattern='^back_to_duo$'),
-                CallbackQueryHandler(trio, pattern='^back_to_trio$'),
-                CallbackQueryHandler(quad, pattern='^back_to_quad$'),
-                CallbackQueryHandler(quad_plus, pattern='^back_to_quad_plus$'),
-                CallbackQueryHandler(find_clan, pattern='^back_to_clan$'),
-                
-                # Обработчики для клана
-                CallbackQueryHandler(apply_application, pattern='^apply_clan$'),
-                CallbackQueryHandler(list_applications, pattern='^list_clan$'),
-                CallbackQueryHandler(my_apps_clan, pattern='^my_apps_clan$'),
-                CallbackQueryHandler(back_from_clan_list, pattern='^back_from_clan_list$'),
-                
-                # Обработчики для тиммейтов
-                CallbackQueryHandler(apply_application, pattern='^apply_(duo|trio|quad|quad_plus)$'),
-                CallbackQueryHandler(list_applications, pattern='^list_(duo|trio|quad|quad_plus)$'),
-                CallbackQueryHandler(my_applications, pattern='^my_apps_(duo|trio|quad|quad_plus)$'),
-                
-                # Общие обработчики
-                CallbackQueryHandler(edit_application, pattern='^edit_'),
-                CallbackQueryHandler(delete_application, pattern='^delete_'),
-                CallbackQueryHandler(confirm_remove, pattern='^confirm_remove$'),
-                CallbackQueryHandler(cancel_remove, pattern='^cancel_remove$'),
-                CallbackQueryHandler(handle_prev_page, pattern='^prev_page_'),
-                CallbackQueryHandler(handle_next_page, pattern='^next_page_'),
-                CallbackQueryHandler(cancel_edit, pattern='^cancel_edit$'),
-                
-                # Навигация
-                CallbackQueryHandler(start, pattern='^back_to_main$'),
+                CallbackQueryHandler(route_choosing_callback),
             ],
             TYPING_APPLICATION: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, save_application),
-                CallbackQueryHandler(start, pattern='^back_to_main$'),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(save_application)),
+                CallbackQueryHandler(timed_handler(start), pattern='^back_to_main$'),
             ],
             TYPING_ADMIN_INPUT: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_confirm_delete_app),
-                CallbackQueryHandler(start, pattern='^back_to_main$'),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(admin_input)),
+                CallbackQueryHandler(timed_handler(admin_all_applications), pattern='^admin_all_apps$'),
+                CallbackQueryHandler(timed_handler(start), pattern='^back_to_main$'),
             ],
             EDITING: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, save_edited_application),
-                CallbackQueryHandler(cancel_edit, pattern='^cancel_edit$'),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(save_edited_application)),
+                CallbackQueryHandler(timed_handler(cancel_edit), pattern='^cancel_edit$'),
+            ],
+            TYPING_SEARCH: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(search_input)),
+                CallbackQueryHandler(route_choosing_callback),
             ]
         },
-        fallbacks=[CommandHandler('start', start)],
-        per_message=False
+        fallbacks=[
+            CommandHandler('start', timed_handler(start)),
+            CommandHandler('search', timed_handler(search_command)),
+        ],
+        per_message=False,
+        name='main_conversation',
+        persistent=True
     )
     
     application.add_handler(conv_handler)
+    application.add_handler(ChatMemberHandler(timed_handler(handle_channel_member_update), ChatMemberHandler.CHAT_MEMBER))
     
     # Добавляем тестовую команду для проверки
     async def test(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Бот работает! Используйте /start")
     
     application.add_handler(CommandHandler('test', test))
+    return application
+
+def main() -> None:
+    application = build_application()
+    
+    if BOT_MODE == 'webhook':
+        asyncio.run(run_webhook(application))
+        return
     
     logger.info("Бот запущен и ожидает сообщений...")
-    application.run_polling()
+    # chat_member не входит в обновления по умолчанию, запрашиваем его явно
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,267 @@
+"""Офлайн-бенчмарк бота: прогоняет синтетических пользователей через сценарий
+start -> duo -> apply_duo -> заявка -> list_duo -> следующая страница
+без обращения к Telegram и пишет результаты в JSON.
+
+Запуск:
+    python benchmark.py --users 2000 --output benchmark_results.json
+    python benchmark.py --baseline old_results.json   # сравнить с прошлым прогоном
+
+База и users.csv создаются во временной папке, рабочие файлы бота не трогаются.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from telegram.request import BaseRequest
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class FakeRequest(BaseRequest):
+    """Сетевой слой бота без сети: запоминает вызовы Bot API и отвечает заготовками."""
+
+    def __init__(self):
+        self.calls = {}
+        self.last_markup = {}
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        elif endpoint == 'getChatMember':
+            result = {'status': 'member', 'user': {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'u'}}
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id', 0))
+            # Клавиатура последнего ответа нужна, чтобы нажать "Следующая"
+            if 'reply_markup' in params:
+                self.last_markup[chat_id] = params['reply_markup']
+            result = {
+                'message_id': next(self._message_ids), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def _user(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'u{user_id}', 'username': f'user{user_id}'}
+
+    def message(self, user_id, text):
+        from telegram import Update
+        message = {
+            'message_id': next(self._message_ids), 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id), 'text': text
+        }
+        if text.startswith('/'):
+            # Сущность команды покрывает только саму команду, без аргументов
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return Update.de_json({'update_id': next(self._update_ids), 'message': message}, self.bot)
+
+    def callback(self, user_id, data):
+        from telegram import Update
+        return Update.de_json({'update_id': next(self._update_ids), 'callback_query': {
+            'id': str(next(self._message_ids)), 'from': self._user(user_id), 'chat_instance': 'bench', 'data': data,
+            'message': {
+                'message_id': next(self._message_ids), 'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'bench'}, 'text': 'menu'
+            }
+        }}, self.bot)
+
+
+def next_page_data(markup):
+    for row in (markup or {}).get('inline_keyboard', []):
+        for button in row:
+            if button.get('callback_data', '').startswith('next_page:'):
+                return button['callback_data']
+    return None
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+async def run_benchmark(bot_module, users):
+    request = FakeRequest()
+    application = bot_module.build_application(request=request)
+    factory = UpdateFactory(application.bot)
+    processor = bot_module.update_processor
+
+    # Счетчик обращений к базе и исходные замеры обработчиков для перцентилей
+    db_ops = [0]
+    submit = bot_module.db._submit
+
+    async def counting_submit(*args):
+        db_ops[0] += 1
+        return await submit(*args)
+
+    bot_module.db._submit = counting_submit
+    samples = {}
+    observe = bot_module.metrics.observe
+
+    def recording_observe(name, value, **labels):
+        if name == 'bot_handler_duration_seconds' and labels.get('phase') == 'total':
+            samples.setdefault(labels['handler'], []).append(value)
+        observe(name, value, **labels)
+
+    bot_module.metrics.observe = recording_observe
+
+    user_ids = range(100000, 100000 + users)
+    stages = [
+        ('start', lambda uid: factory.message(uid, '/start')),
+        ('duo', lambda uid: factory.callback(uid, 'duo')),
+        ('apply_duo', lambda uid: factory.callback(uid, 'apply_duo')),
+        ('save_application', lambda uid: factory.message(
+            uid, f'{18 + uid % 30} лет\n{uid % 5000} часов\nКомбатёр\nОт {uid % 8 + 1} часов в день\nuser#{uid}')),
+        ('list_duo', lambda uid: factory.callback(uid, 'list_duo')),
+        ('next_page', lambda uid: factory.callback(uid, next_page_data(request.last_markup.get(uid)) or 'list_duo')),
+    ]
+
+    await application.initialize()
+    await application.start()
+    results = {'stages': {}}
+    total_updates = 0
+    started = time.perf_counter()
+    try:
+        for name, make_update in stages:
+            stage_started = time.perf_counter()
+            expected = processor.started_total + users
+            for uid in user_ids:
+                application.update_queue.put_nowait(make_update(uid))
+            # Ждем, пока все обновления этапа будут взяты в работу и обработаны
+            while processor.started_total < expected or processor.running:
+                await asyncio.sleep(0.005)
+            elapsed = time.perf_counter() - stage_started
+            total_updates += users
+            results['stages'][name] = {
+                'updates': users,
+                'seconds': round(elapsed, 4),
+                'updates_per_second': round(users / elapsed, 1),
+            }
+        duration = time.perf_counter() - started
+    finally:
+        await application.stop()
+        await application.shutdown()
+        bot_module.db._submit = submit
+        bot_module.metrics.observe = observe
+
+    all_samples = [value for values in samples.values() for value in values]
+    results.update({
+        'users': users,
+        'updates': total_updates,
+        'seconds': round(duration, 4),
+        'updates_per_second': round(total_updates / duration, 1),
+        'handler_latency_ms': {
+            'p50': round(percentile(all_samples, 0.5) * 1000, 3),
+            'p99': round(percentile(all_samples, 0.99) * 1000, 3),
+        },
+        'handlers': {
+            handler: {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 0.5) * 1000, 3),
+                'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+            }
+            for handler, values in sorted(samples.items())
+        },
+        'db_ops_per_update': round(db_ops[0] / total_updates, 3),
+        'api_calls_per_update': round(sum(request.calls.values()) / total_updates, 3),
+        'api_calls': dict(sorted(request.calls.items())),
+    })
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=BOT_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(results, baseline):
+    print(f"Сравнение с {baseline.get('revision') or 'базовым прогоном'}:")
+    rows = [
+        ('updates_per_second', results['updates_per_second'], baseline.get('updates_per_second')),
+        ('p50, мс', results['handler_latency_ms']['p50'], baseline.get('handler_latency_ms', {}).get('p50')),
+        ('p99, мс', results['handler_latency_ms']['p99'], baseline.get('handler_latency_ms', {}).get('p99')),
+        ('db_ops_per_update', results['db_ops_per_update'], baseline.get('db_ops_per_update')),
+        ('api_calls_per_update', results['api_calls_per_update'], baseline.get('api_calls_per_update')),
+    ]
+    for name, current, previous in rows:
+        if previous:
+            print(f"  {name}: {previous} -> {current} ({(current - previous) / previous * 100:+.1f}%)")
+        else:
+            print(f"  {name}: {current}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарк бота на синтетических обновлениях')
+    parser.add_argument('--users', type=int, default=2000, help='количество синтетических пользователей')
+    parser.add_argument('--output', default='benchmark_results.json', help='куда записать результаты')
+    parser.add_argument('--baseline', help='JSON прошлого прогона для сравнения')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)
+
+    with tempfile.TemporaryDirectory(prefix='bot-bench-') as workdir:
+        # Модуль бота при импорте открывает базу и users.csv в текущей папке
+        os.chdir(workdir)
+        sys.path.insert(0, BOT_DIR)
+        import TG_bot_rust_stable2 as bot_module
+        bot_module.METRICS_PORT = None
+        logging.getLogger('apscheduler').setLevel(logging.WARNING)
+
+        results = asyncio.run(run_benchmark(bot_module, args.users))
+        bot_module.db.close()
+
+    results['revision'] = git_revision()
+    results['timestamp'] = datetime.now().isoformat(timespec='seconds')
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, ensure_ascii=False, indent=2)
+
+    print(f"{results['updates']} обновлений за {results['seconds']} с: {results['updates_per_second']} в секунду")
+    print(f"Задержка обработчиков: p50 {results['handler_latency_ms']['p50']} мс, p99 {results['handler_latency_ms']['p99']} мс")
+    print(f"Запросов к базе на обновление: {results['db_ops_per_update']}, к Bot API: {results['api_calls_per_update']}")
+    print(f"Результаты записаны в {output}")
+    if baseline:
+        print_comparison(results, baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,406 @@
+# Слой доступа к базе SQLite: пул соединений, профиль запросов и SQL бота.
+# Импорт модуля ничего не открывает - базу открывает тот, кто создает Database
+import asyncio
+import contextvars
+import functools
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Время по фазам (db, api) текущего обработчика; None вне обработчиков
+handler_phases = contextvars.ContextVar('handler_phases', default=None)
+# Имя текущего обработчика для профиля запросов к базе
+current_handler = contextvars.ContextVar('current_handler', default=None)
+
+def add_phase_time(phase, started):
+    phases = handler_phases.get()
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + time.perf_counter() - started
+
+# Профиль запросов к базе
+@functools.lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    return ' '.join(sql.split())
+
+def params_shape(params):
+    """Типы параметров без значений: по ним видно вариант запроса, но не данные пользователей."""
+    if isinstance(params, dict):
+        return '{' + ', '.join(f'{name}: {type(value).__name__}' for name, value in params.items()) + '}'
+    return '(' + ', '.join(type(value).__name__ for value in params) + ')'
+
+class QueryRun:
+    """Одно выполнение запроса: время и строки накапливаются по мере чтения результата."""
+    __slots__ = ('key', 'handler', 'elapsed', 'slow')
+
+    def __init__(self, sql, shape):
+        self.key = (normalize_sql(sql), shape)
+        self.handler = current_handler.get()
+        self.elapsed = 0.0
+        self.slow = False
+
+class QueryStat:
+    __slots__ = ('calls', 'total', 'max', 'rows', 'handlers')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.handlers = {}
+
+class QueryProfiler:
+    """Статистика запросов за текущее окно. Обновляется из потоков пула базы, поэтому под замком."""
+
+    def __init__(self, slow_threshold=0.1):
+        self.slow_threshold = slow_threshold
+        self.slow_total = 0
+        self._lock = threading.Lock()
+        self._reset_window()
+
+    def _reset_window(self):
+        self._stats = {}
+        self._slow = 0
+        self._window_started = time.monotonic()
+
+    def record(self, run, elapsed, rows=0, new=False):
+        """Добавляет к выполнению run время и прочитанные строки; new=True - запрос только что запущен."""
+        run.elapsed += elapsed
+        with self._lock:
+            stat = self._stats.get(run.key)
+            if stat is None:
+                stat = self._stats[run.key] = QueryStat()
+            if new:
+                stat.calls += 1
+                stat.handlers[run.handler] = stat.handlers.get(run.handler, 0) + 1
+            stat.total += elapsed
+            stat.rows += rows
+            stat.max = max(stat.max, run.elapsed)
+            slow = not run.slow and run.elapsed >= self.slow_threshold
+            if slow:
+                run.slow = True
+                self._slow += 1
+                self.slow_total += 1
+        if slow:
+            sql, shape = run.key
+            logger.warning(f"Медленный запрос: {run.elapsed * 1000:.0f} мс в {run.handler or 'фоне'}: {sql} {shape}")
+
+    def report(self, top=10, reset=False):
+        """Текстовый отчет по top запросам с наибольшим суммарным временем."""
+        with self._lock:
+            stats = sorted(self._stats.items(), key=lambda item: item[1].total, reverse=True)
+            window = time.monotonic() - self._window_started
+            slow = self._slow
+            if reset:
+                self._reset_window()
+        calls = sum(stat.calls for _, stat in stats)
+        total = sum(stat.total for _, stat in stats)
+        lines = [
+            f"📊 Запросы к базе за {window:.0f} с: {calls} выполнений, {total:.2f} с, "
+            f"медленнее {self.slow_threshold * 1000:.0f} мс: {slow}"
+        ]
+        for i, ((sql, shape), stat) in enumerate(stats[:top], 1):
+            handlers = sorted(stat.handlers.items(), key=lambda item: item[1], reverse=True)
+            callers = ', '.join(f"{handler or 'фон'} {count}" for handler, count in handlers[:3])
+            lines.append(
+                f"{i}. {stat.calls}× всего {stat.total * 1000:.0f} мс, макс. {stat.max * 1000:.0f} мс, "
+                f"строк {stat.rows}, параметры {shape}; {callers}\n   {sql[:200]}"
+            )
+        return '\n'.join(lines)
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Курсор, сообщающий профилю своего соединения о каждом запросе и прочитанных строках."""
+    _run = None
+
+    def execute(self, sql, parameters=()):
+        self._run = QueryRun(sql, params_shape(parameters))
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            # Строки SELECT и RETURNING считаются при чтении, для остальных берется rowcount
+            rows = self.rowcount if self.description is None and self.rowcount > 0 else 0
+            self.connection.profiler.record(self._run, time.perf_counter() - started, rows, new=True)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._run = QueryRun(sql, 'many')
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.profiler.record(self._run, time.perf_counter() - started, max(self.rowcount, 0), new=True)
+
+    def _record_fetch(self, started, rows):
+        if self._run is not None:
+            self.connection.profiler.record(self._run, time.perf_counter() - started, rows)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._record_fetch(started, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._record_fetch(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._record_fetch(started, len(rows))
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._record_fetch(started, 0)
+            raise
+        self._record_fetch(started, 1)
+        return row
+
+class ProfiledConnection(sqlite3.Connection):
+    """Соединение, все запросы которого идут через ProfiledCursor и учитываются в profiler."""
+    profiler = None
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+# Слой доступа к базе данных
+class Database:
+    """Пул долгоживущих соединений SQLite. Все запросы выполняются вне event loop.
+    Если передан profiler (QueryProfiler), каждый запрос учитывается в нем."""
+
+    def __init__(self, path, readers=2, profiler=None):
+        self.path = path
+        self.profiler = profiler
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        # Один поток-писатель сериализует изменения, читатели работают параллельно благодаря WAL
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+
+    def _connection(self):
+        # У каждого потока пула свое соединение, живущее до закрытия пула.
+        # Кэш подготовленных запросов sqlite3 переиспользует их между вызовами.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path, cached_statements=256, check_same_thread=False,
+                factory=sqlite3.Connection if self.profiler is None else ProfiledConnection
+            )
+            if self.profiler is not None:
+                conn.profiler = self.profiler
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=5000')
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _fetchone(self, sql, params):
+        return self._connection().execute(sql, params).fetchone()
+
+    def _fetchall(self, sql, params):
+        return self._connection().execute(sql, params).fetchall()
+
+    def _transaction(self, func):
+        conn = self._connection()
+        with conn:
+            return func(conn)
+
+    async def _submit(self, executor, func, *args):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            # Контекст копируется в поток, чтобы профиль запросов знал текущий обработчик
+            return await loop.run_in_executor(executor, contextvars.copy_context().run, func, *args)
+        finally:
+            add_phase_time('db', started)
+
+    async def fetchone(self, sql, params=()):
+        return await self._submit(self._readers, self._fetchone, sql, params)
+
+    async def fetchall(self, sql, params=()):
+        return await self._submit(self._readers, self._fetchall, sql, params)
+
+    async def execute(self, sql, params=()):
+        """Выполняет изменяющий запрос в потоке-писателе и возвращает курсор."""
+        return await self._submit(self._writer, self._transaction, lambda conn: conn.execute(sql, params))
+
+    async def transaction(self, func):
+        """Выполняет func(conn) в потоке-писателе внутри одной транзакции."""
+        return await self._submit(self._writer, self._transaction, func)
+
+    def run_sync(self, func):
+        """Синхронный вариант transaction() для кода, работающего до запуска event loop."""
+        return self._writer.submit(self._transaction, func).result()
+
+    def close(self):
+        # Обновляем статистику планировщика перед выходом, чтобы индексы выбирались правильно
+        try:
+            self.run_sync(lambda conn: conn.execute('PRAGMA optimize'))
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при оптимизации базы данных: {e}")
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+# Колонки с полями заявки, разобранными из текста (parse_application)
+PARSED_APPLICATION_COLUMNS = ('age_years', 'hours_played', 'online_hours', 'members_total', 'role_mask', 'parse_version')
+
+SQL_STORE_PARSED = (
+    'UPDATE applications SET ' + ', '.join(f'{column} = ?' for column in PARSED_APPLICATION_COLUMNS) + ' WHERE id = ?'
+)
+
+# Индексы таблицы заявок под реальные запросы бота. Частичные индексы (WHERE is_active = 1)
+# хранят только активные заявки, поэтому не растут вместе с историей удаленных.
+APPLICATION_INDEXES = [
+    # "Мои заявки", удаление из поиска. team_type в индекс не входит: у клановых
+    # заявок он пустой, а заявок одного пользователя всегда немного
+    '''CREATE INDEX IF NOT EXISTS idx_applications_user
+       ON applications (user_id, app_type, created_at, id) WHERE is_active = 1''',
+    # Полный список в админ-панели с фильтрами по статусу, типу и пользователю
+    '''CREATE INDEX IF NOT EXISTS idx_applications_status
+       ON applications (is_active, created_at, id)''',
+    '''CREATE INDEX IF NOT EXISTS idx_applications_type
+       ON applications (app_type, team_type, created_at, id)''',
+    '''CREATE INDEX IF NOT EXISTS idx_applications_user_history
+       ON applications (user_id, created_at, id)''',
+    # Списки категорий, в том числе с фильтрами: обход в порядке списка, а условия
+    # по возрасту, часам, онлайну и ролям проверяются по самому индексу, без чтения строк таблицы
+    '''CREATE INDEX IF NOT EXISTS idx_applications_parsed
+       ON applications (app_type, team_type, created_at, id, age_years, hours_played, online_hours, role_mask)
+       WHERE is_active = 1''',
+]
+
+_COUNTER_INCREMENT = '''
+    INSERT INTO application_counters (app_type, team_type, is_active, total)
+    VALUES (NEW.app_type, IFNULL(NEW.team_type, ''), NEW.is_active, 1)
+    ON CONFLICT (app_type, team_type, is_active) DO UPDATE SET total = total + 1;
+'''
+
+_COUNTER_DECREMENT = '''
+    UPDATE application_counters SET total = total - 1
+    WHERE app_type = OLD.app_type AND team_type = IFNULL(OLD.team_type, '') AND is_active = OLD.is_active;
+'''
+
+APPLICATION_COUNTER_TRIGGERS = [
+    f'''CREATE TRIGGER IF NOT EXISTS trg_application_counters_insert
+       AFTER INSERT ON applications
+       BEGIN {_COUNTER_INCREMENT} END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_application_counters_update
+       AFTER UPDATE OF app_type, team_type, is_active ON applications
+       WHEN OLD.app_type IS NOT NEW.app_type
+         OR OLD.team_type IS NOT NEW.team_type
+         OR OLD.is_active IS NOT NEW.is_active
+       BEGIN {_COUNTER_DECREMENT} {_COUNTER_INCREMENT} END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_application_counters_delete
+       AFTER DELETE ON applications
+       BEGIN {_COUNTER_DECREMENT} END''',
+]
+
+# Полнотекстовый индекс хранит только активные заявки: удаленные из поиска не мешают
+# ранжированию и не растят индекс. "ё" заменяется на "е" и в тексте, и в запросах,
+# потому что токенизатор их не отождествляет.
+APPLICATION_FTS_COLUMNS = ('role', 'clan_name', 'leader_name', 'required')
+
+def fts_values(row):
+    return ', '.join(
+        f"replace(replace(IFNULL({row}.{column}, ''), 'ё', 'е'), 'Ё', 'Е')" for column in APPLICATION_FTS_COLUMNS
+    )
+
+_FTS_INSERT = f'''
+    INSERT INTO applications_fts (rowid, {', '.join(APPLICATION_FTS_COLUMNS)})
+    SELECT NEW.id, {fts_values('NEW')} WHERE NEW.is_active = 1;
+'''
+
+APPLICATION_FTS_TRIGGERS = [
+    f'''CREATE TRIGGER IF NOT EXISTS trg_applications_fts_insert
+       AFTER INSERT ON applications
+       BEGIN {_FTS_INSERT} END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_applications_fts_update
+       AFTER UPDATE OF {', '.join(APPLICATION_FTS_COLUMNS)}, is_active ON applications
+       BEGIN DELETE FROM applications_fts WHERE rowid = OLD.id; {_FTS_INSERT} END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_applications_fts_delete
+       AFTER DELETE ON applications
+       BEGIN DELETE FROM applications_fts WHERE rowid = OLD.id; END''',
+]
+
+# Запросы к таблице заявок. Условие is_active = 1 записано литералом,
+# иначе SQLite не сможет использовать частичные индексы.
+# Админ-список листается по ключу (created_at, id): первая страница, страница
+# после последней показанной заявки (старее) и перед первой показанной (новее).
+# Параметры: фильтры, затем ключ границы и размер страницы.
+LIST_FIRST = 'ORDER BY a.created_at DESC, a.id DESC LIMIT ?'
+LIST_AFTER = 'AND (a.created_at, a.id) < (?, ?) ORDER BY a.created_at DESC, a.id DESC LIMIT ?'
+LIST_BEFORE = 'AND (a.created_at, a.id) > (?, ?) ORDER BY a.created_at ASC, a.id ASC LIMIT ?'
+
+# Активные заявки для индекса в памяти (ActiveApplicationIndex)
+SQL_ACTIVE_APPS = '''
+SELECT a.id, a.created_at, a.user_id, a.app_type, a.team_type, u.username, 
+       a.age, a.hours, a.role, a.online, a.discord, a.date, 
+       a.clan_name, a.leader_name, a.required, a.members_count, 
+       a.age_years, a.hours_played, a.online_hours, a.members_total, a.role_mask 
+FROM applications a
+LEFT JOIN users u ON a.user_id = u.user_id
+WHERE a.is_active = 1
+'''
+
+SQL_ACTIVE_APP = SQL_ACTIVE_APPS + 'AND a.id = ?'
+
+SQL_USER_ACTIVE_APPS = '''
+SELECT id, app_type, team_type FROM applications 
+WHERE user_id = ? AND is_active = 1
+'''
+
+SQL_DEACTIVATE_USER_APPS = 'UPDATE applications SET is_active = 0 WHERE user_id = ? AND is_active = 1'
+
+SQL_EXPIRE_APPS = '''
+UPDATE applications SET is_active = 0
+WHERE created_at < ? AND is_active = 1
+RETURNING id, user_id, app_type, team_type
+'''
+
+SQL_PARSE_BACKFILL = '''
+SELECT id, app_type, age, hours, role, online, required, members_count FROM applications
+WHERE id > ? AND parse_version IS NOT ?
+ORDER BY id
+LIMIT ?
+'''
+
+SQL_OUTBOX_DUE = '''
+SELECT id, chat_id, text, parse_mode, attempts FROM outbox 
+WHERE not_before <= ? 
+ORDER BY not_before, id 
+LIMIT ?
+'''
+
+SQL_OUTBOX_NEXT_DUE = 'SELECT MIN(not_before) FROM outbox WHERE not_before > ?'
+
+# Веса колонок для bm25 в порядке APPLICATION_FTS_COLUMNS: совпадение в имени лидера весит меньше остальных
+SQL_SEARCH = '''
+SELECT rowid FROM applications_fts 
+WHERE applications_fts MATCH ? 
+ORDER BY bm25(applications_fts, 2.0, 2.0, 1.0, 2.0) 
+LIMIT ? OFFSET ?
+'''
+
+SQL_SEARCH_COUNT = 'SELECT COUNT(*) FROM applications_fts WHERE applications_fts MATCH ?'